@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from clients import get_storage_client
+from error_handler import flush_failures
+from ratelimit import log_limiter_stats
+from utils import name_resources
+from main import fhir_file_to_fhirstore
+
+# Bulk backfill of a whole GCS prefix, run from the command line instead of one function
+# invocation per file. Each file goes through the same fhir_file_to_fhirstore code the Cloud
+# Function runs, in a pool of worker threads, so the function's environment variables
+# (GCP_PROJECT, FHIR_DATASET, FHIR_DATASET_LOCATION, API_VERSION, ...) configure it the same way.
+#
+#   python backfill.py gs://bucket/prefix/ [--sites a b] [--versions R4] [--workers 8]
+#
+# Files are grouped by HPO site and FHIR version, read from the path as name_resources does,
+# and queued one group after another. Every finished file is appended to a local checkpoint
+# file (JSON lines), so an interrupted run started again with the same checkpoint skips what
+# is done; failed files are tried again. Within a file, the per-file GCS checkpoints still apply.
+
+# Split a gs://bucket/prefix uri.
+# Returns: string bucket and string prefix
+def parse_uri(uri):
+    bucket_name, _, prefix = uri.removeprefix('gs://').partition('/')
+
+    return bucket_name, prefix
+
+# Returns: string default local checkpoint file for a backfill of the uri
+def default_checkpoint_path(uri):
+    return f'backfill-{re.sub("[^A-Za-z0-9_.-]+", "-", uri.removeprefix("gs://")).strip("-")}.ndjson'
+
+# The GCS event fields fhir_file_to_fhirstore and import_fhir read, for one listed file.
+# Returns: dict request payload
+def file_request(blob):
+    return {
+        'bucket': blob.bucket.name,
+        'name': blob.name,
+        'size': str(blob.size),
+        'generation': str(blob.generation),
+        'md5Hash': blob.md5_hash,
+        'crc32c': blob.crc32c,
+        'id': f'{blob.bucket.name}/{blob.name}/{blob.generation}',
+    }
+
+# List the FHIR files under the prefix, grouped by site and FHIR version.
+# Staged copies written by fhir_to_fhirstore itself are left out.
+# Returns: dict of (site, version) to list of request payloads, in listing order
+def list_file_groups(bucket_name, prefix, sites=None, versions=None):
+    staging_prefix = os.environ.get('STAGING_PREFIX', 'staging').strip('/')
+    groups = {}
+    for blob in get_storage_client().list_blobs(bucket_name, prefix=prefix):
+        if not blob.name.endswith('.json') or blob.name.startswith(f'{staging_prefix}/'):
+            continue
+        fhir_version, _, _, hpo_site = name_resources(blob.name, {'fhir_version': 'NOT_FOUND'})
+        fhir_version = 'unknown' if fhir_version == 'NOT_FOUND' else fhir_version
+        if (sites and hpo_site not in sites) or (versions and fhir_version not in versions):
+            continue
+        groups.setdefault((hpo_site, fhir_version), []).append(file_request(blob))
+
+    return groups
+
+# Returns: string key of one upload of a file in the local checkpoint
+def file_key(request_json):
+    return f'gs://{request_json["bucket"]}/{request_json["name"]}#{request_json["generation"]}'
+
+# Read the files a previous run finished from the local checkpoint file.
+# A line cut short by an interrupted write is ignored.
+# Returns: set of file keys
+def load_done(checkpoint_path):
+    done = set()
+    if not os.path.exists(checkpoint_path):
+        return done
+    with open(checkpoint_path) as checkpoint_file:
+        for line in checkpoint_file:
+            try:
+                record = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                continue
+            if record.get('status') in ('success', 'skipped'):
+                done.add(record['file'])
+
+    return done
+
+# Run one file through fhir_file_to_fhirstore and classify the outcome.
+# Returns: dict checkpoint record
+def backfill_file(request_json):
+    start = time.monotonic()
+    record = {'file': file_key(request_json), 'status': 'failure', 'resources': 0}
+    try:
+        result = fhir_file_to_fhirstore(request_json)
+        if isinstance(result, dict) and result.get('result') == 'success':
+            record.update(status='success', resources=result.get('resources', 0))
+        elif isinstance(result, dict):
+            record.update(reason=result.get('reason'), status_code=result.get('status_code'))
+        else:
+            record.update(status='skipped', reason=str(result))
+    except Exception as exc:
+        record.update(reason=f'{type(exc).__name__}: {exc}')
+    record['seconds'] = round(time.monotonic() - start, 3)
+
+    return record
+
+# Returns: dict of files done, failed and left, and files and resources per second so far
+def progress_stats(progress):
+    with progress['lock']:
+        elapsed = time.monotonic() - progress['start']
+        counts = dict(progress['counts'])
+        resources = progress['resources']
+    finished = sum(counts.values())
+
+    return {
+        'files_done': counts.get('success', 0) + counts.get('skipped', 0),
+        'files_failed': counts.get('failure', 0),
+        'files_left': progress['total'] - finished,
+        'resources': resources,
+        'elapsed_seconds': round(elapsed, 1),
+        'files_per_second': round(finished / elapsed, 2) if elapsed else 0,
+        'resources_per_second': round(resources / elapsed, 1) if elapsed else 0,
+    }
+
+# Print a progress line every interval seconds until stopped; failure reports are sent as it goes.
+# Returns: None
+def report_progress(progress, interval, stopped):
+    while not stopped.wait(interval):
+        print(json.dumps({'metric': 'backfill_progress', **progress_stats(progress)}))
+        flush_failures()
+
+# Backfill every file under the uri that the local checkpoint doesn't list as done.
+# Each file is recorded as soon as it finishes, whatever the order.
+# Returns: dict final stats
+def run_backfill(uri, checkpoint_path, workers, sites=None, versions=None, report_interval=30, dry_run=False):
+    bucket_name, prefix = parse_uri(uri)
+    groups = list_file_groups(bucket_name, prefix, sites, versions)
+    done = load_done(checkpoint_path)
+
+    queued = []
+    for (hpo_site, fhir_version), files in groups.items():
+        pending = [ request_json for request_json in files if file_key(request_json) not in done ]
+        print(f'{hpo_site} {fhir_version}: {len(pending)} of {len(files)} files to backfill.')
+        queued += pending
+    if dry_run or not queued:
+        return {'files_left': len(queued)}
+
+    progress = {'lock': threading.Lock(), 'start': time.monotonic(), 'total': len(queued),
+                'counts': Counter(), 'resources': 0}
+    stopped = threading.Event()
+    reporter = threading.Thread(target=report_progress, args=(progress, report_interval, stopped), daemon=True)
+    reporter.start()
+
+    print(f'Backfilling {len(queued)} files from {uri} with {workers} workers; checkpoint {checkpoint_path}.')
+    try:
+        with open(checkpoint_path, 'a') as checkpoint_file, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [ executor.submit(backfill_file, request_json) for request_json in queued ]
+            for future in as_completed(futures):
+                record = future.result()
+                with progress['lock']:
+                    progress['counts'][record['status']] += 1
+                    progress['resources'] += record['resources']
+                    checkpoint_file.write(json.dumps(record) + '\n')
+                    checkpoint_file.flush()
+                if record['status'] == 'failure':
+                    print(f'Failed to backfill {record["file"]}. {record.get("reason")}')
+    finally:
+        stopped.set()
+        log_limiter_stats()
+        flush_failures()
+
+    stats = progress_stats(progress)
+    print(json.dumps({'metric': 'backfill', 'uri': uri, **stats}))
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Import every FHIR file under a GCS prefix into the FHIR stores.')
+    parser.add_argument('uri', help='gs://bucket/prefix to backfill')
+    parser.add_argument('--sites', nargs='+', help='only backfill these HPO sites')
+    parser.add_argument('--versions', nargs='+', help="only backfill these FHIR versions ('unknown' if the path names none)")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('BACKFILL_WORKERS', 8)),
+                        help='files processed at once (default: BACKFILL_WORKERS or 8)')
+    parser.add_argument('--checkpoint', help='local checkpoint file (default: derived from the uri)')
+    parser.add_argument('--report-interval', type=float, default=30, help='seconds between progress lines')
+    parser.add_argument('--dry-run', action='store_true', help='list the groups and files left, and stop')
+    args = parser.parse_args()
+
+    stats = run_backfill(args.uri, args.checkpoint or default_checkpoint_path(args.uri), args.workers,
+                         args.sites, args.versions, args.report_interval, args.dry_run)
+
+    return 1 if stats.get('files_failed') else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
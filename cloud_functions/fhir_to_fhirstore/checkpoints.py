@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import time
+from google.api_core import exceptions
+from clients import get_storage_client
+
+# Per-file checkpoint ledger, so a retried task resumes from the first step it hadn't finished.
+# The ledger of a file is one JSON object, {CHECKPOINT_PREFIX}/{bucket}/{name}/{generation}.json
+# (prefix default: staging/checkpoints) in CHECKPOINT_BUCKET, or STAGING_BUCKET if that is unset.
+# It must be a bucket import_fhir does not watch: every save finalizes an object, and in the
+# upload bucket each save would invoke import_fhir only to be skipped. With neither set, there
+# are no checkpoints and a retried task starts over. Keying on the object generation means a re-upload of the file starts over,
+# while a retry or redelivery of the same upload resumes.
+# The state records:
+#   importing: the import operations started for one FHIR version, the versions tried so far
+#              and the staged copies they read
+#   imported: the FHIR version and stores the file was imported into
+#   identified: per store, how many identified resources have been queued
+#   complete: True once every step has finished
+# Progress is saved at most every CHECKPOINT_INTERVAL seconds (GCS allows about one write
+# per second to an object); anything not yet saved is simply redone, and every step is idempotent.
+
+# Open the checkpoint of one upload of a file.
+# Returns: checkpoint dict, or None if the request has no generation, CHECKPOINT_PREFIX is empty
+#          or no checkpoint bucket is set
+def load_checkpoint(file_bucket, file_name, generation):
+    staging_prefix = os.environ.get('STAGING_PREFIX', 'staging').strip('/')
+    checkpoint_prefix = os.environ.get('CHECKPOINT_PREFIX', f'{staging_prefix}/checkpoints').strip('/')
+    checkpoint_bucket = os.environ.get('CHECKPOINT_BUCKET', os.environ.get('STAGING_BUCKET'))
+    if not generation or not checkpoint_prefix or not checkpoint_bucket:
+        return None
+
+    bucket = get_storage_client().bucket(checkpoint_bucket)
+    blob = bucket.blob(f'{checkpoint_prefix}/{file_bucket}/{file_name}/{generation}.json')
+    try:
+        state = json.loads(blob.download_as_text())
+        print(f'Resuming from checkpoint gs://{bucket.name}/{blob.name}: {sorted(state)}')
+    except exceptions.NotFound:
+        state = {}
+
+    return {'blob': blob, 'state': state, 'lock': threading.Lock(), 'saved': time.monotonic()}
+
+# Write the checkpoint now, or only if CHECKPOINT_INTERVAL has passed since the last write.
+# A failed write is logged and not raised: losing a checkpoint only costs repeated work.
+# Returns: None
+def save_checkpoint(checkpoint, force=True):
+    if checkpoint is None:
+        return
+    interval = float(os.environ.get('CHECKPOINT_INTERVAL', 2))
+    with checkpoint['lock']:
+        if not force and time.monotonic() - checkpoint['saved'] < interval:
+            return
+        data = json.dumps(checkpoint['state'])
+        checkpoint['saved'] = time.monotonic()
+    try:
+        checkpoint['blob'].upload_from_string(data, content_type='application/json')
+    except Exception as exc:
+        print(f'Checkpoint not saved. {exc}')
+
+# Returns: the value recorded for a stage, or None if the stage isn't complete
+def checkpoint_stage(checkpoint, stage):
+    if checkpoint is None:
+        return None
+
+    return checkpoint['state'].get(stage)
+
+# Record a completed stage and save the checkpoint.
+# Returns: None
+def complete_stage(checkpoint, stage, value=True):
+    if checkpoint is None:
+        return
+    with checkpoint['lock']:
+        checkpoint['state'][stage] = value
+    save_checkpoint(checkpoint)
+
+# Returns: int number of identified resources already queued for a store
+def identified_count(checkpoint, resource_path):
+    if checkpoint is None:
+        return 0
+
+    return checkpoint['state'].get('identified', {}).get(resource_path, 0)
+
+# Record that count more identified resources were queued for a store; saved at most every interval.
+# Returns: None
+def add_identified(checkpoint, resource_path, count):
+    if checkpoint is None:
+        return
+    with checkpoint['lock']:
+        identified = checkpoint['state'].setdefault('identified', {})
+        identified[resource_path] = identified.get(resource_path, 0) + count
+    save_checkpoint(checkpoint, force=False)
+
+# Mark an import_fhir deduplication ledger entry (gs:// uri) as imported, so identical content
+# uploaded later is skipped for the ledger's full TTL instead of its shorter pending TTL.
+# Only call this once every import of the content has succeeded.
+# Returns: None
+def confirm_dedup_entry(dedup_entry):
+    if not dedup_entry:
+        return
+    bucket_name, _, blob_name = dedup_entry.removeprefix('gs://').partition('/')
+    blob = get_storage_client().bucket(bucket_name).get_blob(blob_name)
+    if blob is None:
+        return
+    try:
+        blob.metadata = {'state': 'imported', 'recorded': str(time.time())}
+        blob.patch(if_generation_match=blob.generation)
+    except Exception as exc:
+        print(f'Deduplication entry {dedup_entry} not confirmed. {exc}')
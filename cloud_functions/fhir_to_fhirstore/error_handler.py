@@ -3,7 +3,8 @@ import google.oauth2.id_token
 import os
 import requests
 import json
-from google.cloud import pubsub_v1
+import threading
+from clients import get_publisher_client
 
 def report_failure(failure: dict) -> dict:
  #   url: str = os.environ.get(
@@ -42,15 +43,21 @@ def make_authorized_request(url: str, json: dict, method: str = 'GET'):
 
 
 
+# Publish futures not yet confirmed, flushed once at the end of the invocation by flush_failures.
+_pending = []
+_pending_lock = threading.Lock()
+
 # Publishes a message to a Cloud Pub/Sub topic.
+# The message is handed to the publisher's background batch and the future kept, so reporting
+# a failure doesn't wait for Pub/Sub; call flush_failures before the invocation returns.
 def publish(request):
 
-    # Instantiates a Pub/Sub client
-    publisher = pubsub_v1.PublisherClient()
+    # Reuse the process-wide Pub/Sub client
+    publisher = get_publisher_client()
 
     # References an existing topic
-    project_id = 'aou-curation-omop-dev'
-    topic_name = 'site-fhir-data-error-handler'
+    project_id = os.environ.get('ERROR_PROJECT', os.environ.get('GCP_PROJECT', 'aou-curation-omop-dev'))
+    topic_name = os.environ.get('ERROR_TOPIC', 'site-fhir-data-error-handler')
     topic_path = publisher.topic_path(project_id, topic_name)
 
     message_json = json.dumps({
@@ -61,8 +68,30 @@ def publish(request):
     # Publishes a message
     try:
         publish_future = publisher.publish(topic_path, data=message_bytes)
-        publish_future.result()  # Verify the publish succeeded
-        return 'Message published.'
+        with _pending_lock:
+            _pending.append(publish_future)
+        return 'Message queued.'
     except Exception as e:
         print(e)
         return (e, 500)
+
+
+# Wait for the messages published during this invocation, so none are lost when the
+# instance is idled after the response. Failures are logged, not raised.
+# Returns: int number of messages that failed to publish
+def flush_failures(timeout: float = 30) -> int:
+    with _pending_lock:
+        pending = list(_pending)
+        _pending.clear()
+
+    failed = 0
+    for publish_future in pending:
+        try:
+            publish_future.result(timeout=timeout)
+        except Exception as e:
+            print(f'Failed to publish failure report. {e}')
+            failed += 1
+
+    if pending:
+        print(f'Published {len(pending) - failed} of {len(pending)} failure reports.')
+    return failed
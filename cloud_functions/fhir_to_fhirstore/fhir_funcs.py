@@ -1,7 +1,12 @@
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions
+from googleapiclient import errors
 from googleapiclient import discovery
-from google.cloud import tasks_v2
+from ratelimit import limited_call
+from task_producer import build_http_task, enqueue_tasks, get_queue_path
+from utils import IDENTIFIER_KINDS, chunked, identifier_system
 
 # Create the FHIR dataset.
 # Returns: response
@@ -12,7 +17,7 @@ def create_fhir_dataset(hc_client, dataset_id, dataset_parent):
         .datasets()
         .create(parent=dataset_parent, body={}, datasetId=dataset_id)
     )
-    response = request.execute()
+    response = limited_call('healthcare', request.execute)
 
     return response
 
@@ -30,7 +35,7 @@ def create_fhir_store(hc_client, fhir_version, fhir_store_id, fhir_store_parent)
         .fhirStores()
         .create(parent=fhir_store_parent, body=body, fhirStoreId=fhir_store_id)
     )
-    response = request.execute()
+    response = limited_call('healthcare', request.execute)
     
     return response
 
@@ -44,10 +49,48 @@ def load_fhir_resource(hc_client, resource_path, resource_body):
         .fhirStores()
         .import_(name=resource_path, body=resource_body)
     )  
-    response = request.execute()
+    response = limited_call('healthcare', request.execute)
 
     return response
 
+# Get the HTTP status code of a Healthcare API (HttpError), FHIR REST (requests.HTTPError)
+# or Cloud Tasks (GoogleAPICallError) error.
+# Returns: int status code or None
+def error_status(exc):
+    if isinstance(exc, errors.HttpError):
+        return exc.resp.status
+    if getattr(exc, 'response', None) is not None:
+        return exc.response.status_code
+
+    return getattr(exc, 'code', None)
+
+# The body of a failed Healthcare API call, e.g. the OperationOutcome of a rejected executeBundle.
+# Returns: string
+def error_detail(exc):
+    if isinstance(exc, errors.HttpError):
+        content = exc.content
+        return content.decode('utf-8', 'replace') if isinstance(content, bytes) else str(content)
+    if getattr(exc, 'response', None) is not None:
+        return exc.response.text
+
+    return str(exc)
+
+# Load several FHIR resource files to the FHIR store, max_workers imports at a time.
+# Errors are returned in place of responses so one failed file doesn't stop the others.
+# Returns: list of responses or HttpErrors, in the same order as resource_bodies
+def load_fhir_resources(hc_client, resource_path, resource_bodies, max_workers=8):
+    def load(resource_body):
+        try:
+            return load_fhir_resource(hc_client, resource_path, resource_body)
+        except errors.HttpError as exc:
+            return exc
+
+    if len(resource_bodies) <= 1:
+        return [load(resource_body) for resource_body in resource_bodies]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(resource_bodies))) as executor:
+        return list(executor.map(load, resource_bodies))
+
 #def patch_fhir_identification(base_url, resource_path, resource_type, resource_id, id_list):
 #    import json
 #
@@ -63,33 +106,220 @@ def load_fhir_resource(hc_client, resource_path, resource_body):
 #
 #    return response  
 
-# Creates update request to add identifiers to FHIR resource.
-# Calls identify_fhir to add request to task queue.
-# Returns: response
-def update_fhir_json(base_url, resource_path, fhir_json, resource_type, resource_id, resource_identifier, id_list):
+# Creates update request for an identified FHIR resource.
+# Returns: tuple of identify method, resource path, headers and json
+def build_update_request(base_url, resource_path, fhir_json, resource_type, resource_id):
 
     id_resource_path = f'{base_url}/{resource_path}/fhir/{resource_type}/{resource_id}'
     headers = {"Content-Type": "application/fhir+json;charset=utf-8"}
 
-    if resource_identifier == 'NOT_FOUND':
-        fhir_json['identifier'] = [{ "value": id_list_value } for id_list_value in id_list]
+    return ('UPDATE', id_resource_path, headers, fhir_json)
+
+# Add the identifiers to a FHIR resource in place, keyed on (system, value), so merging the same
+# identifiers again leaves the resource as it was. Identifiers written before systems were added
+# ({"value": "HPO Site: x"}) are replaced by their system form. A resource type whose identifier
+# is a single value rather than a list is left alone.
+# Returns: bool True if the resource changed
+def merge_identifiers(fhir_json, id_list):
+    identifiers = fhir_json.get('identifier', [])
+    if not isinstance(identifiers, list):
+        return False
+
+    legacy_prefixes = tuple(f'{label}: ' for label, kind in IDENTIFIER_KINDS)
+    kept = [ identifier for identifier in identifiers
+             if not (isinstance(identifier, dict) and 'system' not in identifier
+                     and str(identifier.get('value', '')).startswith(legacy_prefixes)) ]
+    index = { (identifier.get('system'), identifier.get('value')) for identifier in kept if isinstance(identifier, dict) }
+    added = [ dict(identifier) for identifier in id_list if (identifier['system'], identifier['value']) not in index ]
+
+    if not added and len(kept) == len(identifiers):
+        return False
+    fhir_json['identifier'] = kept + added
+
+    return True
+
+# Add the identifiers to each resource of a stream as it passes through.
+# With changed_only, resources that already had them are counted in counts['unchanged'] and dropped.
+# Returns: generator of the enriched resources
+def enrich_resources(resources, id_list, changed_only=False, counts=None):
+    for resource in resources:
+        if merge_identifiers(resource, id_list) or not changed_only:
+            yield resource
+        elif counts is not None:
+            counts['unchanged'] = counts.get('unchanged', 0) + 1
+
+# Write a stream of enriched resources to the staging prefix so they can be imported in one operation.
+# staging_format is 'bundle' (a collection Bundle) or 'ndjson' (one resource per line).
+# Returns: string GCS uri of the staged object, the import content structure and the number of resources
+def stage_resources(bucket, staging_prefix, file_name, resources, staging_format):
+    count = 0
+    if staging_format == 'ndjson':
+        blob = bucket.blob(f'{staging_prefix}/{file_name.removesuffix(".json")}.ndjson')
+        with blob.open('wt', encoding='utf-8', content_type='application/fhir+ndjson') as staged_file:
+            for resource in resources:
+                staged_file.write(json.dumps(resource) + '\n')
+                count += 1
+        content_structure = 'RESOURCE'
     else:
-        for id_list_value in id_list:
-            fhir_json['identifier'].append({ "value": id_list_value })
+        blob = bucket.blob(f'{staging_prefix}/{file_name}')
+        with blob.open('wt', encoding='utf-8', content_type='application/fhir+json') as staged_file:
+            staged_file.write('{"resourceType": "Bundle", "type": "collection", "entry": [')
+            for resource in resources:
+                staged_file.write((',' if count else '') + json.dumps({ "resource": resource }))
+                count += 1
+            staged_file.write(']}')
+        content_structure = 'BUNDLE'
 
-    response = identify_fhir('UPDATE', id_resource_path, headers, fhir_json)
+    return f'gs://{bucket.name}/{blob.name}', content_structure, count
 
-    return response    
+# Write a stream of resources to size-bounded NDJSON shards under the staging prefix,
+# so a large file can be imported as several operations in parallel.
+# Returns: list of string GCS uris of the shards and the number of resources
+def stage_resource_shards(bucket, staging_prefix, file_name, resources, shard_max_bytes):
+    shard_uris = []
+    count = 0
+    shard_file = None
+    shard_bytes = 0
+    try:
+        for resource in resources:
+            line = json.dumps(resource) + '\n'
+            line_bytes = len(line.encode('utf-8'))
+            if shard_file is None or (shard_bytes and shard_bytes + line_bytes > shard_max_bytes):
+                if shard_file is not None:
+                    shard_file.close()
+                blob = bucket.blob(f'{staging_prefix}/{file_name.removesuffix(".json")}/shard-{len(shard_uris):05d}.ndjson')
+                shard_file = blob.open('wt', encoding='utf-8', content_type='application/fhir+ndjson')
+                shard_uris.append(f'gs://{bucket.name}/{blob.name}')
+                shard_bytes = 0
+            shard_file.write(line)
+            shard_bytes += line_bytes
+            count += 1
+    finally:
+        if shard_file is not None:
+            shard_file.close()
 
-# Adds request to task queue to avoid RATE LIMIT errors.
-# Returns: response
-def identify_fhir(identify_method, id_resource_path, headers, fhir_json):
+    return shard_uris, count
+
+# Delete staged copies or shards (gs:// uris) once their imports have succeeded, so staging
+# only holds files still being imported. A copy that is already gone is skipped.
+# Returns: int number of objects deleted
+def delete_staged_files(storage_client, staged_uris):
+    deleted = 0
+    for staged_uri in staged_uris:
+        bucket_name, _, blob_name = staged_uri.removeprefix('gs://').partition('/')
+        try:
+            storage_client.bucket(bucket_name).blob(blob_name).delete()
+            deleted += 1
+        except exceptions.NotFound:
+            pass
+
+    return deleted
+
+# Build one transaction Bundle that writes every resource of a small file with the identifiers merged:
+# a PUT for each resource with an id and a POST for the rest. fullUrl is kept so the store resolves
+# references between entries (e.g. urn:uuid) as it would for the original Bundle.
+# Returns: Bundle dict
+def build_transaction_bundle(entries, id_list):
+    bundle_entries = []
+    for entry in entries:
+        resource = entry.get('resource') if isinstance(entry, dict) else None
+        if not isinstance(resource, dict) or 'resourceType' not in resource:
+            continue
+        if 'id' in resource:
+            request = { "method": "PUT", "url": f'{resource["resourceType"]}/{resource["id"]}' }
+        else:
+            request = { "method": "POST", "url": resource["resourceType"] }
+        merge_identifiers(resource, id_list)
+        bundle_entry = { "resource": resource, "request": request }
+        if 'fullUrl' in entry:
+            bundle_entry['fullUrl'] = entry['fullUrl']
+        bundle_entries.append(bundle_entry)
+
+    return { "resourceType": "Bundle", "type": "transaction", "entry": bundle_entries }
+
+# Execute a Bundle against a FHIR store in a single request.
+# Raises: requests.HTTPError if the store rejects it; a rejected transaction changes nothing
+# Returns: response Bundle dict
+def execute_fhir_bundle(session, base_url, resource_path, bundle):
+    headers = {"Content-Type": "application/fhir+json;charset=utf-8"}
+    response = limited_call('healthcare', session.post, f'{base_url}/{resource_path}/fhir', headers=headers, data=json.dumps(bundle))
+    response.raise_for_status()
 
-    #print(f"Queuing {id_resource_path} with {identify_method}.")
-    identify_task_dict = { "method": identify_method,
-                           "resource_path": id_resource_path,
-                           "request_header": headers,
-                           "request_json": fhir_json }
+    return response.json()
+
+# Group identified resources into batch or transaction Bundles of PUT entries.
+# A Bundle is closed once it holds batch_size entries or would exceed max_bytes,
+# so each one fits in a single task payload.
+# Returns: generator of Bundle dicts
+def iter_identify_bundles(resources, bundle_type, batch_size, max_bytes):
+    entries = []
+    entries_size = 0
+    for resource in resources:
+        if 'resourceType' not in resource or 'id' not in resource:
+            continue
+        entry = { "resource": resource,
+                  "request": { "method": "PUT", "url": f'{resource["resourceType"]}/{resource["id"]}' } }
+        entry_size = len(json.dumps(entry))
+        if entries and (len(entries) >= batch_size or entries_size + entry_size > max_bytes):
+            yield { "resourceType": "Bundle", "type": bundle_type, "entry": entries }
+            entries = []
+            entries_size = 0
+        entries.append(entry)
+        entries_size += entry_size
+
+    if entries:
+        yield { "resourceType": "Bundle", "type": bundle_type, "entry": entries }
+
+# Creates executeBundle requests that update identified resources in each FHIR store.
+# Calls identify_fhir_batch to add one request per Bundle and store to the task queue,
+# a few Bundles at a time so the resources are never all held in memory.
+# After each submission, progress (if given) is called with the number of resources queued.
+# Returns: int number of requests queued
+def identify_fhir_bundles(base_url, resource_paths, resources, bundle_type, batch_size, max_bytes, progress=None):
+
+    headers = {"Content-Type": "application/fhir+json;charset=utf-8"}
+    queued = 0
+
+    for bundles in chunked(iter_identify_bundles(resources, bundle_type, batch_size, max_bytes), 10):
+        identify_requests = [ ('BUNDLE', f'{base_url}/{resource_path}/fhir', headers, bundle)
+                              for resource_path in resource_paths for bundle in bundles ]
+        identify_fhir_batch(identify_requests)
+        queued += len(identify_requests)
+        if progress is not None:
+            progress(sum(len(bundle['entry']) for bundle in bundles))
+
+    return queued
+
+# Creates update requests for identified resources in each FHIR store.
+# Calls identify_fhir_batch to add them to the task queue chunk_size resources at a time.
+# After each submission, progress (if given) is called with the number of resources queued.
+# Returns: int number of requests queued
+def identify_fhir_updates(base_url, resource_paths, resources, chunk_size=500, progress=None):
+
+    queued = 0
+
+    for resource_chunk in chunked(resources, chunk_size):
+        identify_requests = [ build_update_request(base_url, resource_path, resource, resource.get('resourceType'), resource.get('id'))
+                              for resource_path in resource_paths for resource in resource_chunk ]
+        identify_fhir_batch(identify_requests)
+        queued += len(identify_requests)
+        if progress is not None:
+            progress(len(resource_chunk))
+
+    return queued
+
+# A single request is sent as it always was; several are sent as a list under "requests".
+# Returns: task dict
+def build_identify_task(url, service_account_email, task_requests):
+    if len(task_requests) == 1:
+        return build_http_task(url, service_account_email, task_requests[0])
+
+    return build_http_task(url, service_account_email, { "requests": task_requests })
+
+# Adds many requests to the task queue at once, submitted concurrently.
+# identify_requests is a list of (identify_method, id_resource_path, headers, fhir_json) tuples.
+# Returns: list of responses
+def identify_fhir_batch(identify_requests):
 
     # Set the queue and cloud function variables.
     project = os.environ.get('GCP_PROJECT')    
@@ -101,39 +331,31 @@ def identify_fhir(identify_method, id_resource_path, headers, fhir_json):
     # Build the url from the cloud function variables.
     url = f"https://{location}-{project}.cloudfunctions.net/{identify_function}"
 
-    # Create a client.
-    client = tasks_v2.CloudTasksClient()
-
-    # Construct the fully qualified queue name.
-    parent = client.queue_path(project, location, queue_name)
+    # The queue is resolved and verified once per process.
+    parent = get_queue_path(project, location, queue_name)
 
-    # Get the queue object.
-    queue = client.get_queue(request=None, name=parent)
+    # Several requests share a task so identify_fhir can apply them concurrently: up to
+    # IDENTIFY_TASK_SIZE requests, or fewer if the payload would exceed IDENTIFY_TASK_BYTES.
+    task_size = int(os.environ.get('IDENTIFY_TASK_SIZE', 50))
+    task_bytes = int(os.environ.get('IDENTIFY_TASK_BYTES', 900000))
 
-    # Create the task queue if it doesn't exist; update if it already exists.
-    client.update_queue(request=None, queue=queue)
-
-    # Construct the request body.
-    task = {
-        "http_request": {  # Specify the type of request.
-            "http_method": tasks_v2.HttpMethod.POST,
-            "url": url,  # The full url path that the task will be sent to.
-            "oidc_token": {"service_account_email": service_account_email, "audience": url},
-        }
-    }
-
-    if isinstance(identify_task_dict, dict):
-        # Convert dict to JSON string.
-        identify_task_dict = json.dumps(identify_task_dict)
-
-    if identify_task_dict is not None:
-        # The API expects a payload of type bytes.
-        converted_payload = identify_task_dict.encode()
-
-        # Add the payload to the request body.
-        task['http_request']['body'] = converted_payload  
-    
-    # Use the client to build and send the task.
-    response = client.create_task(request={"parent": parent, "task": task})  
+    tasks = []
+    task_requests = []
+    task_requests_bytes = 0
+    for identify_method, id_resource_path, headers, fhir_json in identify_requests:
+        identify_task_dict = { "method": identify_method,
+                               "resource_path": id_resource_path,
+                               "request_header": headers,
+                               "request_json": fhir_json }
+        identify_task_bytes = len(json.dumps(identify_task_dict))
+        if task_requests and (len(task_requests) >= task_size or task_requests_bytes + identify_task_bytes > task_bytes):
+            tasks.append(build_identify_task(url, service_account_email, task_requests))
+            task_requests = []
+            task_requests_bytes = 0
+        task_requests.append(identify_task_dict)
+        task_requests_bytes += identify_task_bytes
+    if task_requests:
+        tasks.append(build_identify_task(url, service_account_email, task_requests))
 
-    return response     
+    # Use the shared producer to send the tasks.
+    return enqueue_tasks(parent, tasks)
@@ -0,0 +1,127 @@
+import json
+import os
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+_number_characters = '0123456789.eE+-'
+
+# Incrementally parse a FHIR JSON document from a text file object.
+# For a Bundle, yields each element of the top-level "entry" array one at a time, so memory
+# is bounded by the chunk size and the largest entry rather than by the file size.
+# Every other top-level member is decoded into header; members that come after "entry" are
+# only in header once the generator is exhausted. A document that is not a Bundle is a single
+# resource: its members all go into header, including an "entry" of its own (e.g. a List),
+# and it is yielded as one {"resource": ...} entry. "entry" is only streamed when
+# "resourceType": "Bundle" comes before it; otherwise it is decoded whole and its elements
+# are yielded at the end if the document turns out to be a Bundle.
+# Raises: json.decoder.JSONDecodeError for malformed or truncated input
+def iter_fhir_entries(text_file, header, chunk_size=1024 * 1024):
+    state = {'buffer': '', 'pos': 0, 'eof': False}
+
+    # Read more of the file; grow geometrically so a large value is retried O(log n) times.
+    def fill():
+        buffer = state['buffer'][state['pos']:]
+        data = text_file.read(max(chunk_size, len(buffer)))
+        if not data:
+            state['eof'] = True
+        state['buffer'] = buffer + data
+        state['pos'] = 0
+
+    def error(message):
+        return json.decoder.JSONDecodeError(message, state['buffer'], state['pos'])
+
+    # Skip whitespace and return the next character without consuming it ('' at end of file).
+    def peek():
+        while True:
+            buffer, pos = state['buffer'], state['pos']
+            while pos < len(buffer) and buffer[pos] in _whitespace:
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buffer) or state['eof']:
+                return buffer[pos] if pos < len(buffer) else ''
+            fill()
+
+    def expect(character):
+        if peek() != character:
+            raise error(f'Expecting {character!r}')
+        state['pos'] += 1
+
+    # After a member or element: consume a ',' and return True, or the closing character and return False.
+    def next_item(closing, name):
+        character = peek()
+        if character == ',':
+            state['pos'] += 1
+            return True
+        if character == closing:
+            state['pos'] += 1
+            return False
+        if character == '':
+            raise error(f'Unterminated {name}')
+        raise error("Expecting ',' delimiter")
+
+    # Decode the next JSON value, reading more of the file until it is complete.
+    def decode():
+        peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(state['buffer'], state['pos'])
+                # A number cut by the end of the buffer (e.g. '0.' or '1.5e') decodes as its
+                # prefix, so it may continue in the next chunk.
+                cut = (isinstance(value, (int, float)) and not isinstance(value, bool)
+                       and not state['buffer'][end:].strip(_number_characters))
+                if not cut or state['eof']:
+                    state['pos'] = end
+                    return value
+            except json.decoder.JSONDecodeError:
+                if state['eof']:
+                    raise
+            fill()
+
+    expect('{')
+    streamed = False
+    more = peek() != '}'
+    if not more:
+        state['pos'] += 1
+    while more:
+        if peek() != '"':
+            raise error('Expecting property name enclosed in double quotes')
+        key = decode()
+        expect(':')
+        if key == 'entry' and header.get('resourceType') == 'Bundle' and peek() == '[':
+            streamed = True
+            state['pos'] += 1
+            more_entries = peek() != ']'
+            if not more_entries:
+                state['pos'] += 1
+            while more_entries:
+                yield decode()
+                more_entries = next_item(']', 'entry array')
+        else:
+            header[key] = decode()
+        more = next_item('}', 'object')
+    if peek() != '':
+        raise error('Extra data')
+
+    if header.get('resourceType') != 'Bundle':
+        yield {'resource': header}
+    elif not streamed and isinstance(header.get('entry'), list):
+        yield from header.pop('entry')
+
+# Open a GCS blob and stream its FHIR entries, reading STREAM_CHUNK_SIZE characters at a time.
+# Returns: generator of entries (see iter_fhir_entries)
+def open_fhir_entries(blob, header):
+    chunk_size = int(os.environ.get('STREAM_CHUNK_SIZE', 1024 * 1024))
+
+    def entries():
+        with blob.open('rt', encoding='utf-8', chunk_size=chunk_size) as text_file:
+            yield from iter_fhir_entries(text_file, header, chunk_size)
+
+    return entries()
+
+# Select the resources from a stream of entries.
+# Returns: generator of resource dicts
+def iter_resources(entries):
+    for entry in entries:
+        resource = entry.get('resource') if isinstance(entry, dict) else None
+        if isinstance(resource, dict):
+            yield resource
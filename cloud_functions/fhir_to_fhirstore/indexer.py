@@ -0,0 +1,45 @@
+from versions import score_resource
+
+# Add one resource to the index.
+# Returns: None
+def index_resource(file_index, resource):
+    resource_type = resource.get('resourceType', 'NOT_FOUND')
+    file_index['resource_count'] += 1
+    file_index['counts'][resource_type] = file_index['counts'].get(resource_type, 0) + 1
+    score_resource(resource, file_index['version_scores'])
+
+# Start an empty index; it is filled by index_entries and completed by finish_index.
+# Returns: dict with
+#   resource_type: top-level resourceType or NOT_FOUND
+#   fhir_version: top-level FHIRVersion value or NOT_FOUND
+#   resource_count: number of resources
+#   counts: dict of resourceType to number of resources
+#   version_scores: version evidence, see versions.py
+def new_index():
+    return {
+        'resource_type': 'NOT_FOUND',
+        'fhir_version': 'NOT_FOUND',
+        'resource_count': 0,
+        'counts': {},
+        'version_scores': {},
+    }
+
+# Index each entry of a stream as it passes through, so the same single traversal
+# can feed later stages.
+# Returns: generator of the entries
+def index_entries(file_index, entries):
+    for entry in entries:
+        resource = entry.get('resource') if isinstance(entry, dict) else None
+        if isinstance(resource, dict):
+            index_resource(file_index, resource)
+        yield entry
+
+# Complete the index from the top-level members once the stream is exhausted.
+# Returns: the index
+def finish_index(file_index, header):
+    file_index['resource_type'] = header.get('resourceType', 'NOT_FOUND')
+    file_index['fhir_version'] = header.get('FHIRVersion', 'NOT_FOUND')
+    if file_index['resource_type'] == 'Bundle':
+        score_resource(header, file_index['version_scores'])
+
+    return file_index
@@ -1,14 +1,179 @@
 import google.auth.transport.requests
 import google.oauth2.id_token    
+import itertools
 import json
 import os
 import requests
 import sys
+import time
 from google.cloud import storage, exceptions, tasks_v2
 from googleapiclient import discovery, errors
 from fhir_funcs import *
 from utils import *
 from error_handler import *
+from clients import get_authorized_session, get_healthcare_client, get_storage_client
+from stores import ensure_fhir_dataset, ensure_fhir_store, invalidate
+from versions import best_version, score_resource
+from indexer import finish_index, index_entries, new_index
+from fhir_stream import iter_resources, open_fhir_entries
+from ratelimit import log_limiter_stats
+from checkpoints import add_identified, checkpoint_stage, complete_stage, confirm_dedup_entry, identified_count, load_checkpoint, save_checkpoint
+from operations import log_execute_metrics, log_import_metrics, wait_for_operations
+
+# Load the staged or original files into one FHIR store, in parallel when there are several.
+# Progress is reported for the source file as a whole.
+# Raises: the first HttpError, once every import has been attempted
+# Returns: list of responses
+def load_fhir_resource_files(hc_client, resource_path, resource_bodies, import_workers):
+    responses = load_fhir_resources(hc_client, resource_path, resource_bodies, import_workers)
+    import_errors = [ response for response in responses if isinstance(response, errors.HttpError) ]
+    if len(resource_bodies) > 1:
+        print(f'Started {len(responses) - len(import_errors)} of {len(responses)} imports into {resource_path}.')
+    if import_errors:
+        raise import_errors[0]
+
+    return responses
+
+# Create the FHIR store if needed and start importing the files into it.
+# Returns: list of import responses
+def import_into_store(hc_client, fhir_version, resource_path, resource_bodies, import_workers):
+    fhir_store_parent, _, fhir_store_id = resource_path.rpartition('/fhirStores/')
+    ensure_fhir_store(hc_client, fhir_version, fhir_store_id, fhir_store_parent)
+
+    return load_fhir_resource_files(hc_client, resource_path, resource_bodies, import_workers)
+
+# Create the FHIR store if needed and write a small file's resources to it in one transaction.
+# The latency is logged whether or not the transaction succeeds.
+# Returns: response Bundle dict
+def execute_into_store(hc_client, fhir_version, base_url, resource_path, bundle, file_uri, hpo_site, file_size):
+    fhir_store_parent, _, fhir_store_id = resource_path.rpartition('/fhirStores/')
+    ensure_fhir_store(hc_client, fhir_version, fhir_store_id, fhir_store_parent)
+
+    start = time.monotonic()
+    succeeded = False
+    try:
+        response = execute_fhir_bundle(get_authorized_session(), base_url, resource_path, bundle)
+        succeeded = True
+    finally:
+        log_execute_metrics(file_uri, hpo_site, fhir_version, resource_path, file_size,
+                            len(bundle['entry']), time.monotonic() - start, succeeded)
+
+    return response
+
+# Stream the file and queue identification of its resources in one FHIR store,
+# either one update per resource or executeBundle batches (IDENTIFY_MODE=bundle).
+# Resources imported with the identifiers already present need no update and are skipped,
+# as are those a previous attempt at this upload already queued (see checkpoints).
+# Returns: int number of requests queued
+def identify_store(blob, base_url, resource_path, id_list, identify_mode, checkpoint=None):
+    counts = {}
+    resources = enrich_resources(iter_resources(open_fhir_entries(blob, {})), id_list, changed_only=True, counts=counts)
+    already_queued = identified_count(checkpoint, resource_path)
+    if already_queued:
+        print(f'Skipping {already_queued} resources already queued for {resource_path}.')
+        resources = itertools.islice(resources, already_queued, None)
+    progress = lambda count: add_identified(checkpoint, resource_path, count)
+    if identify_mode == 'bundle':
+        bundle_type = os.environ.get('IDENTIFY_BUNDLE_TYPE', 'batch').lower()
+        batch_size = int(os.environ.get('IDENTIFY_BATCH_SIZE', 200))
+        batch_bytes = int(os.environ.get('IDENTIFY_BATCH_BYTES', 900000))
+        queued = identify_fhir_bundles(base_url, (resource_path,), resources, bundle_type, batch_size, batch_bytes, progress)
+    else:
+        queued = identify_fhir_updates(base_url, (resource_path,), resources, progress=progress)
+    if counts:
+        print(f'Skipped {counts["unchanged"]} resources in {resource_path} that already had the identifiers.')
+
+    return queued
+
+# Queue identification of the file's resources in the site and combined stores, both at once.
+# An error from either store is raised once both have finished, a retryable one first, so the task
+# is retried; the checkpoint keeps what was queued so the retry continues from there.
+# Returns: dict result
+def identify_file(blob, base_url, resource_paths, id_list, identify_mode, checkpoint=None):
+    identify_results = fan_out(
+        lambda store_path: identify_store(blob, base_url, store_path, id_list, identify_mode, checkpoint),
+        tuple(resource_paths),
+    )
+    save_checkpoint(checkpoint)
+    retry_exc = None
+    for store_path, (queued, exc) in identify_results.items():
+        if exc is None:
+            print(f'Queued {queued} identify requests for {store_path}.')
+            continue
+        print(f'Failed to add identifiers to {store_path}. {error_status(exc)}')
+        if error_status(exc) in (429, 500, 503) or retry_exc is None:
+            retry_exc = exc
+    if retry_exc is not None:
+        raise retry_exc
+
+    return {'result': 'success'}
+
+# Delete the staged copies of a file once no import of them will follow.
+# Returns: None
+def delete_staged(file_uri, staged_uris):
+    if staged_uris:
+        deleted = delete_staged_files(get_storage_client(), staged_uris)
+        print(f'Deleted {deleted} staged files of {file_uri}.')
+
+# Wait for a file's import operations. They are saved in the checkpoint first, so if they outlast
+# the wait, the retry waits for the same operations instead of importing the file again.
+# Once they have finished, the staged copies they imported are deleted, unless every import
+# failed: then they are kept for the next version to try, and deleted by the caller if none is left.
+# Raises: TimeoutError if any are still running after import_timeout seconds, so the task is retried
+# Returns: dict summary (see wait_for_operations)
+def wait_for_imports(hc_client, checkpoint, importing, file_uri, hpo_site, file_size, import_timeout):
+    complete_stage(checkpoint, 'importing', importing)
+    import_summary = wait_for_operations(hc_client, importing['operations'], import_timeout)
+    log_import_metrics(file_uri, hpo_site, importing['fhir_version'], import_summary, file_size)
+    if import_summary['pending']:
+        raise TimeoutError(f'{import_summary["pending"]} imports of {file_uri} into {importing["fhir_version"]} stores '
+                           f'still running after {import_timeout}s.')
+    if import_summary['succeeded'] or not import_summary['failed']:
+        delete_staged(file_uri, importing.get('staged_uris'))
+
+    return import_summary
+
+# Returns: dict failure report for a file whose imports into a version's stores all failed
+def import_failure(request_json, fhir_version, import_summary):
+    import_error = next(operation['error'] for operation in import_summary['operations'].values() if 'error' in operation)
+
+    return {
+        'status': 'failure',
+        'reason': f'Import into {fhir_version} stores failed',
+        'exc': json.dumps(import_error),
+        'status_code': 400,
+        'path': '/'.join(request_json['id'].split('/')[:-1]),
+    }
+
+# Once the file's imports have finished, queue identification of its resources, unless the
+# identifiers were merged before import, and finish the file.
+# Returns: dict result
+def identify_imported(request_json, checkpoint, blob, base_url, imported, id_list, identify_mode, resource_count=None):
+    if identify_mode == 'enrich':
+        print('Identifiers were merged before import; skipping identification.')
+        return finish_file(request_json, checkpoint, resource_count, imported['verified'])
+
+    # Stream the file again for each store and queue identification of its resources.
+    complete_stage(checkpoint, 'imported', imported)
+    print(f'Starting identification of resources from file into {imported["fhir_version"]} stores.')
+    identify_file(blob, base_url, imported['resource_paths'], id_list, identify_mode, checkpoint)
+
+    return finish_file(request_json, checkpoint, resource_count, imported['verified'])
+
+# Record that the file is done: in its checkpoint, and in import_fhir's deduplication ledger.
+# The ledger entry is only confirmed when every import of the file is known to have succeeded;
+# otherwise it expires after its pending TTL, so the same content uploaded again is imported.
+# Returns: dict result, with the number of resources in the file when known
+def finish_file(request_json, checkpoint, resource_count=None, verified=True):
+    complete_stage(checkpoint, 'complete')
+    if verified:
+        confirm_dedup_entry(request_json.get('dedup_entry'))
+    elif request_json.get('dedup_entry'):
+        print(f'Not all imports succeeded; leaving {request_json["dedup_entry"]} unconfirmed.')
+
+    if resource_count is None:
+        return {'result': 'success'}
+    return {'result': 'success', 'resources': resource_count}
 
 def fhir_to_fhirstore(request):
     """Responds to any HTTP request.
@@ -22,13 +187,28 @@ def fhir_to_fhirstore(request):
 
     # Decode the payload.
     request_json = request.data.decode('utf8')
-    failure = {}
 
     try:
         request_json = json.loads(request_json)
     except:
         return 'Bad request'
 
+    # Log how the Healthcare API rate limiter fared and send the failures reported, however the request ends.
+    try:
+        # A micro-batch flushed by import_fhir (IMPORT_BATCH_MODE) names a prefix of files instead of one file.
+        if 'batch_prefix' in request_json:
+            return fhir_batch_to_fhirstore(request_json)
+
+        return fhir_file_to_fhirstore(request_json)
+    finally:
+        log_limiter_stats()
+        flush_failures()
+
+# Import one FHIR file named by a GCS event payload and queue identification of its resources.
+# Returns: dict result, or the failure reported
+def fhir_file_to_fhirstore(request_json):
+    failure = {}
+
     try:
         file_bucket = request_json['bucket'] # The triggering file bucket.
         file_name = request_json['name'] # The triggering file name.
@@ -37,7 +217,9 @@ def fhir_to_fhirstore(request):
 
         assert 'id' in request_json, 'KeyError, path not available'
         assert file_name.endswith('.json'), 'Non-json file extension' 
-        assert int(file_size) < 5000000, 'File exceeds 5MB'
+        # Files are streamed, so there is no size limit unless MAX_FILE_SIZE is set.
+        max_file_size = int(os.environ.get('MAX_FILE_SIZE', 0))
+        assert not max_file_size or int(file_size) < max_file_size, f'File exceeds {max_file_size} bytes'
     except (KeyError, AssertionError) as exc:
         failure = {
             'status': 'failure',
@@ -53,12 +235,17 @@ def fhir_to_fhirstore(request):
     if failure:
         return report_failure(failure)
 
+    # Files written to the staging prefix by this function are imported directly; never reprocess them.
+    staging_prefix = os.environ.get('STAGING_PREFIX', 'staging').strip('/')
+    if file_name.startswith(f'{staging_prefix}/'):
+        return 'Skipping staged file'
+
     # Parse the ID of the request payload to get identifying information from the file path.
     # These identifiers will be added to each FHIR resource found within the file contents.
     id_list = build_identifiers(request_json['id'])
 
-    # Instantiates a Cloud Storage client.
-    storage_client = storage.Client()
+    # Reuse the process-wide Cloud Storage client.
+    storage_client = get_storage_client()
 
     # Create a bucket object for the triggering file bucket.
     bucket = storage_client.get_bucket(file_bucket)
@@ -66,8 +253,88 @@ def fhir_to_fhirstore(request):
     # Create a blob object from the filepath for the triggering file name.
     blob = bucket.blob(file_name)
 
+    # A retry or redelivery of this upload resumes where the last attempt stopped:
+    # a finished file is skipped and an imported one goes straight to identification.
+    identify_mode = os.environ.get('IDENTIFY_MODE', 'task').lower()
+    checkpoint = load_checkpoint(file_bucket, file_name, request_json.get('generation'))
+    if checkpoint_stage(checkpoint, 'complete'):
+        print(f'{file_uri} was already imported and identified.')
+        return {'result': 'success'}
+    imported = checkpoint_stage(checkpoint, 'imported')
+    if imported:
+        print(f'{file_uri} was already imported into {imported["fhir_version"]} stores; resuming identification.')
+        base_url = f"https://healthcare.googleapis.com/{os.environ.get('API_VERSION')}"
+        identify_file(blob, base_url, imported['resource_paths'], id_list, identify_mode, checkpoint)
+        return finish_file(request_json, checkpoint, verified=imported.get('verified', False))
+
+    # Imports that were still running when the last attempt gave up are waited for, not started again.
+    # If they all failed, the file is imported again from the start into the versions not yet tried.
+    # The wait is kept under the default 60 s function timeout, so an attempt gives up on the wait
+    # before it is cut off.
+    import_timeout = int(os.environ.get('IMPORT_OPERATION_TIMEOUT', 50))
+    importing = checkpoint_stage(checkpoint, 'importing')
+    tried_versions = []
+    tried_failure = None
+    if importing:
+        print(f'Resuming the wait for {len(importing["operations"])} imports of {file_uri} into {importing["fhir_version"]} stores.')
+        hc_client = get_healthcare_client(os.environ.get('API_VERSION'))
+        base_url = f"https://healthcare.googleapis.com/{os.environ.get('API_VERSION')}"
+        hpo_site = name_resources(file_name, {'fhir_version': 'NOT_FOUND'})[3]
+        import_summary = wait_for_imports(hc_client, checkpoint, importing, file_uri, hpo_site, file_size, import_timeout)
+        if not import_summary['failed'] or import_summary['succeeded']:
+            imported = {'fhir_version': importing['fhir_version'], 'resource_paths': importing['resource_paths'],
+                        'verified': not import_summary['failed']}
+            return identify_imported(request_json, checkpoint, blob, base_url, imported, id_list, identify_mode,
+                                     importing.get('resource_count'))
+        tried_versions = importing.get('tried', [importing['fhir_version']])
+        tried_failure = import_failure(request_json, importing['fhir_version'], import_summary)
+        print(f'Imports into {importing["fhir_version"]} stores failed; importing the file into the versions not yet tried.')
+
+    # Stream the file once, one bundle entry at a time, indexing each resource as it passes:
+    # its count per type and version hints, which choose the stores to import into.
+    # In enrich mode, the same pass merges the identifiers and writes the staged copy to import.
+    # Files of SHARD_THRESHOLD_BYTES or more are written to NDJSON shards that are imported in parallel.
+    # Files under FAST_PATH_MAX_BYTES with at most FAST_PATH_MAX_ENTRIES resources are kept in memory
+    # and written with one executeBundle transaction per store, skipping the import operation entirely.
+    sharding = int(file_size) >= int(os.environ.get('SHARD_THRESHOLD_BYTES', 100000000))
+    fast_path = int(file_size) < int(os.environ.get('FAST_PATH_MAX_BYTES', 1000000))
+    fast_path_max_entries = int(os.environ.get('FAST_PATH_MAX_ENTRIES', 1000))
+    fast_path_entries = []
+    staged_uris = []
+    file_header = {}
+    file_index = new_index()
+    entries = index_entries(file_index, open_fhir_entries(blob, file_header))
+
     try:    
-        fhir_file_json = json.load(blob.open('rt', encoding='utf-8')) 
+        # A file with too many entries for one transaction falls back to the import path below.
+        if fast_path:
+            fast_path_entries = list(entries)
+            fast_path = len(fast_path_entries) <= fast_path_max_entries
+            entries = iter(fast_path_entries)
+
+        if fast_path:
+            pass
+        elif sharding or identify_mode == 'enrich':
+            staging_bucket = storage_client.bucket(os.environ.get('STAGING_BUCKET', file_bucket))
+            resources = iter_resources(entries)
+            if identify_mode == 'enrich':
+                resources = enrich_resources(resources, id_list)
+
+            if sharding:
+                shard_max_bytes = int(os.environ.get('SHARD_MAX_BYTES', 50000000))
+                staged_uris, staged_count = stage_resource_shards(
+                    staging_bucket, staging_prefix, file_name, resources, shard_max_bytes
+                )
+                content_structure = 'RESOURCE'
+            else:
+                staging_format = os.environ.get('STAGING_FORMAT', 'bundle').lower()
+                staged_uri, content_structure, staged_count = stage_resources(
+                    staging_bucket, staging_prefix, file_name, resources, staging_format
+                )
+                staged_uris = [ staged_uri ]
+        else:
+            for entry in entries:
+                pass
     except json.decoder.JSONDecodeError as exc:
         failure = {
             'status': 'error',
@@ -89,8 +356,9 @@ def fhir_to_fhirstore(request):
 
     # Parse the resource type out of the file and construct the payload.
     # An individual resource or bundle file can be imported with one resource body.
-    # Also, parse bundles to build a list of each resource contained within to be used for adding identification information.
-    resource_type = find_by_key(fhir_file_json, 'resourceType') 
+    finish_index(file_index, file_header)
+    resource_type = file_index['resource_type']
+    print(f'Indexed {file_index["resource_count"]} resources from file: {file_index["counts"]}')
 
     # If resource type key not found in the json, skip the file.
     if resource_type.lower() == 'not_found':
@@ -130,133 +398,352 @@ def fhir_to_fhirstore(request):
     service_name = 'healthcare'
     response = 'Import complete'
     
-    # Instantiates an authorized API client by discovering the Healthcare API.
-    hc_client = discovery.build(service_name, api_version)
+    # Reuse the process-wide authorized Healthcare API client, discovered on first use.
+    hc_client = get_healthcare_client(api_version)
     base_url = f"https://{service_name}.googleapis.com/{api_version}"
 
-    # Try to create the fhir store dataset if it does not exist yet.
+    # If the file was staged while streaming (enriched, sharded or both), import the staged
+    # copies instead of the original file.
+    resource_bodies = [ resource_body ]
+    if staged_uris or sharding:
+        resource_bodies = [ { "contentStructure": content_structure, "gcsSource": { "uri": staged_uri } }
+                            for staged_uri in staged_uris ]
+        print(f'Staged {staged_count} resources to {len(staged_uris)} files: {staged_uris[:3]}')
+    import_workers = int(os.environ.get('IMPORT_WORKERS', 8))
+
+    # Try to create the fhir store dataset if it is not already known to exist.
     dataset_parent = "projects/{}/locations/{}".format(project_id, location)    
-    try:
-        response = create_fhir_dataset(hc_client, dataset_id, dataset_parent)
-        print(f'Created FHIR dataset: {dataset_id}')
-    except errors.HttpError as exc:
-        print(f'FHIR dataset {dataset_id} exists already. {exc.resp["status"]}')
+    ensure_fhir_dataset(hc_client, dataset_id, dataset_parent)
 
     # Try to infer the fhir version from the file (either contents or path information).
     # If can't be determined from the file, 'NOT_FOUND' is returned.
     # In this case, loop through all the valid FHIR specifications, attempting to import the file to each.
-    fhir_version, fhir_store_id, fhir_store_combined_id, fhir_hpo_site = name_resources(file_name, fhir_file_json)
+    fhir_version, fhir_store_id, fhir_store_combined_id, fhir_hpo_site = name_resources(file_name, file_index)
             
+    # Before falling back to trial imports, classify the version from the file contents.
+    # Only an ambiguous file is tried against every version, most likely version first.
     if fhir_store_id == 'NOT_FOUND':
-        fhir_version_list = ['R4', 'STU3', 'DSTU2']
+        detected_version, confidence = best_version(file_index['version_scores'])
+        print(f'Detected FHIR version {detected_version} with confidence {confidence:.2f}.')
+        if confidence >= float(os.environ.get('VERSION_CONFIDENCE', 0.8)):
+            fhir_version_list = [ detected_version ]
+        else:
+            fhir_version_list = sorted(['R4', 'STU3', 'DSTU2'], key=lambda version: version != detected_version)
     else:
         fhir_version_list = [ fhir_version ]
 
+    # Versions an earlier attempt already imported into without success are not tried again.
+    fhir_version_list = [ try_fhir_version for try_fhir_version in fhir_version_list if try_fhir_version not in tried_versions ]
+    if not fhir_version_list:
+        delete_staged(file_uri, staged_uris)
+        return report_failure(tried_failure)
+
+    if fast_path:
+        fast_path_bundle = build_transaction_bundle(fast_path_entries, id_list)
+        print(f'Writing {len(fast_path_bundle["entry"])} resources with executeBundle instead of an import.')
+
+    # The version the file was imported into; stays None if every version tried was rejected.
+    imported_version = None
+    store_errors = {}
+    # Imports started into one store of a version the other store rejected; nobody waits for them.
+    unwaited_imports = False
     for try_fhir_version in fhir_version_list:
         fhir_store_id = f'fhir-{fhir_hpo_site}-{try_fhir_version}'
         fhir_store_combined_id = f'fhir-combined-{try_fhir_version}'
         fhir_store_parent = "projects/{}/locations/{}/datasets/{}".format(project_id, location, dataset_id)  
-        try:
-            response = create_fhir_store(hc_client, try_fhir_version, fhir_store_id, fhir_store_parent)
-            print(f'Created FHIR store: {fhir_store_id}')
-        except errors.HttpError as exc:
-            print(f'FHIR store {fhir_store_id} exists already. {exc.resp["status"]}')
-
-        try:
-            # Build the import statement to load the FHIR resource file into the store.
-            resource_path = "projects/{}/locations/{}/datasets/{}/fhirStores/{}".format(
-                project_id, location, dataset_id, fhir_store_id
+        resource_path = f'{fhir_store_parent}/fhirStores/{fhir_store_id}'
+        combined_resource_path = f'{fhir_store_parent}/fhirStores/{fhir_store_combined_id}'
+
+        # Import into the site store and the combined store concurrently.
+        # Each store's errors are classified on their own, so one slow or failing store doesn't hold up the other.
+        if fast_path:
+            import_results = fan_out(
+                lambda store_path: execute_into_store(hc_client, try_fhir_version, base_url, store_path, fast_path_bundle,
+                                                      file_uri, fhir_hpo_site, file_size),
+                (resource_path, combined_resource_path),
+            )
+        else:
+            import_results = fan_out(
+                lambda store_path: import_into_store(hc_client, try_fhir_version, store_path, resource_bodies, import_workers),
+                (resource_path, combined_resource_path),
             )
-            response = load_fhir_resource(hc_client, resource_path, resource_body)
-            print(f'Loaded {resource_path} successfully.')
-        #    break
-        except errors.HttpError as exc:
-            print(f'Failed to post to {fhir_store_id}. {exc.resp["status"]}')
 
-            # If rate limit exceeded or connection error, raise the error so it will be retried.
+        import_responses = []
+        for store_path, (response, exc) in import_results.items():
+            if exc is None and fast_path:
+                print(f'Executed transaction in {store_path}.')
+                continue
+            if exc is None:
+                import_responses += response
+                print(f'Started import into {store_path}.')
+                continue
+            if not isinstance(exc, (errors.HttpError, requests.HTTPError)):
+                raise exc
+
+            print(f'Failed to post to {store_path}. {error_status(exc)}')
+            store_errors[store_path] = exc
+
+            # The store was deleted since it was confirmed; forget it so the next attempt creates it.
+            if error_status(exc) == 404:
+                invalidate(store_path)
+
+            # If rate limit exceeded or connection error, report it so it will be retried.
             # We don't want to raise other failures as we are processing in a loop.
-            if exc.resp.status in (429, 500, 503):
+            if error_status(exc) in (429, 500, 503):
                 failure = {
                     'status': 'failure',
                     'reason':
-                    f'Failed to post to {fhir_store_id}. {exc.resp["status"]}',
+                    f'Failed to post to {store_path.split("/")[-1]}. {error_status(exc)}',
                     'exc': str(exc),
-                    'status_code': exc.resp.status,
+                    'status_code': error_status(exc),
                     'path': '/'.join(request_json['id'].split('/')[:-1]),
                 }
                 return report_failure(failure)
 
-        # Now for the combined store.
-        try:
-            response = create_fhir_store(hc_client, try_fhir_version, fhir_store_combined_id, fhir_store_parent)
-            print(f'Created FHIR store: {fhir_store_combined_id}')
-        except errors.HttpError as exc:
-            print(f'FHIR store {fhir_store_combined_id} exists already. {exc.resp["status"]}')
+        # As before, a failed import into the combined store means trying the next version.
+        if import_results[combined_resource_path][1] is not None:
+            unwaited_imports = unwaited_imports or bool(import_responses)
+            continue
 
-        try:
-            # Build the import statement to load the FHIR resource file into the store.
-            combined_resource_path = "projects/{}/locations/{}/datasets/{}/fhirStores/{}".format(
-                project_id, location, dataset_id, fhir_store_combined_id
-            )
-            response = load_fhir_resource(hc_client, combined_resource_path, resource_body)
-            print(f'Loaded {combined_resource_path} successfully.')
+        # The combined store took the file but its site store rejected it; the file isn't imported.
+        if import_results[resource_path][1] is not None:
+            unwaited_imports = unwaited_imports or bool(import_responses)
             break
-        except errors.HttpError as exc:
-            print(f'Failed to post to {fhir_store_combined_id}. {exc.resp["status"]}')
 
-            # If rate limit exceeded or connection error, raise the error so it will be retried.
-            # We don't want to raise other failures as we are processing in a loop.
-            if exc.resp.status in (429, 500, 503):
-                failure = {
-                    'status': 'failure',
-                    'reason':
-                    f'Failed to post to {fhir_store_combined_id}. {exc.resp["status"]}',
-                    'exc': str(exc),
-                    'status_code': exc.resp.status,
-                    'path': '/'.join(request_json['id'].split('/')[:-1]),
-                }
-                return report_failure(failure)                
-    
-    # If identifier doesn't exist, add it to the json and execute an update request.
-    # Otherwise, append the identifier to the existing dictionary and execute an update request.
-    if resource_type.lower() == 'bundle':
-        print(f'Starting identification of {len(fhir_file_json["entry"])} resources from file.')
-        for entry in fhir_file_json['entry']:
-            bundle_entry = entry.get('resource')
-            resource_identifier = find_by_key(entry, 'identifier') 
-            resource_group_type = bundle_entry.get('resourceType')
-            resource_group_id = bundle_entry.get('id')
+        # A transaction is complete when executeBundle returns; there is no operation to wait for.
+        if fast_path:
+            imported_version = try_fhir_version
+            break
 
-            try:
-                response = update_fhir_json(base_url, resource_path, bundle_entry, resource_group_type, resource_group_id, resource_identifier, id_list)
-            except errors.HttpError as exc:
-                print(f'Failed to add identifiers to {resource_path}. {exc.resp["status"]}')
-                raise
-            try:
-                response = update_fhir_json(base_url, combined_resource_path, bundle_entry, resource_group_type, resource_group_id, resource_identifier, id_list)
-            except errors.HttpError as exc:
-                print(f'Failed to add identifiers to {combined_resource_path}. {exc.resp["status"]}')
-                raise                
-    else:
-        print('Starting identification of 1 resources from file.')
-        resource_identifier = find_by_key(entry, 'identifier') 
-        resource_group_type = fhir_file_json['resourceType']
-        resource_group_id = fhir_file_json['id']
+        # Wait for the imports to finish so identification never runs before the resources exist:
+        # an identify update would create a resource that the running import then overwrites.
+        # If every import into this version's stores failed, try the next version.
+        importing = {
+            'fhir_version': try_fhir_version,
+            'resource_paths': [resource_path, combined_resource_path],
+            'operations': [ import_response['name'] for import_response in import_responses if 'name' in import_response ],
+            'resource_count': file_index['resource_count'],
+            'staged_uris': staged_uris,
+            'tried': tried_versions + [ try_fhir_version ],
+        }
+        tried_versions = importing['tried']
+        import_summary = wait_for_imports(hc_client, checkpoint, importing, file_uri, fhir_hpo_site, file_size, import_timeout)
+        if import_summary['failed'] and not import_summary['succeeded']:
+            if try_fhir_version != fhir_version_list[-1]:
+                print(f'Imports into {try_fhir_version} stores failed; trying the next version.')
+                continue
+            delete_staged(file_uri, staged_uris)
+            return report_failure(import_failure(request_json, try_fhir_version, import_summary))
+        imported_version = try_fhir_version
+        break
+
+    # Every version was rejected: report the last rejection, with its OperationOutcome, and leave the file unfinished.
+    # The staged copies are kept while an import that nobody waits for may still be reading them.
+    if imported_version is None:
+        if not unwaited_imports:
+            delete_staged(file_uri, staged_uris)
+        store_path, exc = list(store_errors.items())[-1]
+        failure = {
+            'status': 'failure',
+            'reason': f'Failed to post to {store_path.split("/")[-1]}. {error_status(exc)}',
+            'exc': error_detail(exc),
+            'status_code': error_status(exc) or 400,
+            'path': '/'.join(request_json['id'].split('/')[:-1]),
+        }
+        return report_failure(failure)
 
-        # Update the resource in the individual FHIR store.
+    # If identifier doesn't exist, add it to the json and execute an update request.
+    # Otherwise, append the identifier to the existing dictionary and execute an update request.
+    if fast_path:
+        print('Identifiers were merged before import; skipping identification.')
+        return finish_file(request_json, checkpoint, file_index['resource_count'])
+
+    imported = {'fhir_version': imported_version, 'resource_paths': [resource_path, combined_resource_path],
+                'verified': not import_summary['failed']}
+    return identify_imported(request_json, checkpoint, blob, base_url, imported, id_list, identify_mode,
+                             file_index['resource_count'])
+
+
+# Claim batched files for one flush by stamping their metadata with a metageneration precondition,
+# so the scheduled flush of a window and its "-full" flush never import the same file twice.
+# A claim older than BATCH_CLAIM_SECONDS is from a flush that died, and is taken over.
+# Returns: list of claimed blobs and int number of files claimed by another flush
+def claim_batch_blobs(batch_blobs):
+    claim_seconds = float(os.environ.get('BATCH_CLAIM_SECONDS', 600))
+    claimed = []
+    busy = 0
+    for batch_blob in batch_blobs:
+        metadata = dict(batch_blob.metadata or {})
+        if time.time() - float(metadata.get('flush_claimed') or 0) < claim_seconds:
+            busy += 1
+            continue
+        batch_blob.metadata = {**metadata, 'flush_claimed': str(time.time())}
         try:
-            response = update_fhir_json(base_url, resource_path, fhir_file_json, resource_group_type, resource_group_id, resource_identifier, id_list)
-        except errors.HttpError as exc:
-            print(f'Failed to add identifiers to {resource_path}. {exc.resp["status"]}')
-            raise    
-
-        # Update the resource in the combined FHIR store.
+            batch_blob.patch(if_metageneration_match=batch_blob.metageneration)
+            claimed.append(batch_blob)
+        except exceptions.PreconditionFailed:
+            busy += 1
+        except exceptions.NotFound:
+            pass
+
+    return claimed, busy
+
+# Give up a flush's claims, so the retry of the flush can claim the files again.
+# Returns: None
+def release_batch_blobs(batch_blobs):
+    for batch_blob in batch_blobs:
+        batch_blob.metadata = {**(batch_blob.metadata or {}), 'flush_claimed': None}
         try:
-            response = update_fhir_json(base_url, combined_resource_path, fhir_file_json, resource_group_type, resource_group_id, resource_identifier, id_list)
-        except errors.HttpError as exc:
-            print(f'Failed to add identifiers to {combined_resource_path}. {exc.resp["status"]}')
-            raise                  
+            batch_blob.patch()
+        except Exception as exc:
+            print(f'Claim on {batch_blob.name} not released. {exc}')
+
+# Import a micro-batch of files that import_fhir copied under one prefix.
+# Each file gets its own identifiers, and all of them are written to one set of NDJSON shards,
+# so the batch costs one import per shard and store instead of one import per file.
+# The batched copies are only removed, and their deduplication entries confirmed, once every
+# import has succeeded; otherwise the error is raised so Cloud Tasks retries the flush.
+# Raises: the import error, or RuntimeError if imports failed, the version is unknown or the files are claimed elsewhere
+# Returns: dict result
+def fhir_batch_to_fhirstore(request_json):
+    file_bucket = request_json['bucket']
+    batch_prefix = request_json['batch_prefix']
+    batch_uri = f'gs://{file_bucket}/{batch_prefix}'
+    staging_prefix = os.environ.get('STAGING_PREFIX', 'staging').strip('/')
+
+    storage_client = get_storage_client()
+    bucket = storage_client.bucket(file_bucket)
+    staging_bucket = storage_client.bucket(os.environ.get('STAGING_BUCKET', file_bucket))
+
+    # Only the files listed and claimed now are imported and removed; later arrivals wait for the next flush.
+    # Files another flush is importing are left to it; if that leaves nothing, retry until it is done.
+    batch_blobs, busy = claim_batch_blobs(bucket.list_blobs(prefix=batch_prefix))
+    if not batch_blobs and busy:
+        raise RuntimeError(f'{busy} files in {batch_uri} are claimed by another flush.')
+    if not batch_blobs:
+        return {'result': 'success', 'files': 0}
 
-    return {'result': 'success'}
+    try:
+        return import_batch(request_json, storage_client, staging_bucket, staging_prefix, batch_blobs)
+    except Exception:
+        release_batch_blobs(batch_blobs)
+        raise
+
+# Stage, import and remove the claimed files of a micro-batch (see fhir_batch_to_fhirstore).
+# Returns: dict result
+def import_batch(request_json, storage_client, staging_bucket, staging_prefix, batch_blobs):
+    file_bucket = request_json['bucket']
+    batch_prefix = request_json['batch_prefix']
+    fhir_hpo_site = request_json['site']
+    fhir_version = request_json['fhir_version']
+    batch_uri = f'gs://{file_bucket}/{batch_prefix}'
+
+    version_scores = {}
+    # Batched files that could not be read; they are reported, and their deduplication entries left unconfirmed.
+    unread = set()
+
+    def batch_resources():
+        for batch_blob in batch_blobs:
+            source_id = (batch_blob.metadata or {}).get('source_id', f'{file_bucket}/{batch_blob.name}')
+            try:
+                for resource in enrich_resources(iter_resources(open_fhir_entries(batch_blob, {})), build_identifiers(source_id)):
+                    score_resource(resource, version_scores)
+                    yield resource
+            except (json.decoder.JSONDecodeError, exceptions.NotFound) as exc:
+                unread.add(batch_blob.name)
+                report_failure({
+                    'status': 'error',
+                    'reason': 'Error reading batched FHIR file',
+                    'exc': str(exc),
+                    'status_code': 400,
+                    'path': '/'.join(source_id.split('/')[:-1]),
+                })
+
+    shard_max_bytes = int(os.environ.get('SHARD_MAX_BYTES', 50000000))
+    batch_name = f'imports/{fhir_hpo_site}/{fhir_version}/{batch_prefix.rstrip("/").split("/")[-1]}-{int(time.time())}'
+    shard_uris, staged_count = stage_resource_shards(staging_bucket, staging_prefix, batch_name, batch_resources(), shard_max_bytes)
+    print(f'Staged {staged_count} resources from {len(batch_blobs)} files in {batch_uri} to {len(shard_uris)} files.')
+
+    # The path didn't name a version; classify the batch from its contents.
+    if fhir_version == 'unknown':
+        fhir_version, confidence = best_version(version_scores)
+        print(f'Detected FHIR version {fhir_version} with confidence {confidence:.2f}.')
+    # The batched copies are kept for the retry of the flush, which nothing else would pick up.
+    if fhir_version == 'NOT_FOUND':
+        delete_staged_files(storage_client, shard_uris)
+        reason = f'FHIR version of batch {batch_uri} not determined'
+        report_failure({
+            'status': 'error',
+            'reason': 'FHIR version of batch not determined',
+            'exc': '',
+            'status_code': 400,
+            'path': batch_prefix.rstrip('/'),
+        })
+        raise RuntimeError(reason)
 
+    project_id = os.environ.get('GCP_PROJECT')
+    location = os.environ.get('FHIR_DATASET_LOCATION')
+    dataset_id = os.environ.get('FHIR_DATASET')
+    api_version = os.environ.get('API_VERSION')
+    import_workers = int(os.environ.get('IMPORT_WORKERS', 8))
+    import_timeout = int(os.environ.get('IMPORT_OPERATION_TIMEOUT', 50))
+    hc_client = get_healthcare_client(api_version)
+
+    dataset_parent = "projects/{}/locations/{}".format(project_id, location)
+    ensure_fhir_dataset(hc_client, dataset_id, dataset_parent)
+    fhir_store_parent = f'{dataset_parent}/datasets/{dataset_id}'
+    resource_path = f'{fhir_store_parent}/fhirStores/fhir-{fhir_hpo_site}-{fhir_version}'
+    combined_resource_path = f'{fhir_store_parent}/fhirStores/fhir-combined-{fhir_version}'
+    resource_bodies = [ { "contentStructure": "RESOURCE", "gcsSource": { "uri": shard_uri } } for shard_uri in shard_uris ]
+
+    import_results = fan_out(
+        lambda store_path: import_into_store(hc_client, fhir_version, store_path, resource_bodies, import_workers),
+        (resource_path, combined_resource_path),
+    )
+    import_responses = []
+    for store_path, (response, exc) in import_results.items():
+        if exc is not None:
+            print(f'Failed to post to {store_path}. {error_status(exc)}')
+            report_failure({
+                'status': 'failure',
+                'reason': f'Failed to post to {store_path.split("/")[-1]}. {error_status(exc)}',
+                'exc': error_detail(exc),
+                'status_code': error_status(exc) or 500,
+                'path': batch_prefix.rstrip('/'),
+            })
+            raise exc
+        import_responses += response
+
+    operation_names = [ import_response['name'] for import_response in import_responses if 'name' in import_response ]
+    import_summary = wait_for_operations(hc_client, operation_names, import_timeout)
+    log_import_metrics(batch_uri, fhir_hpo_site, fhir_version, import_summary)
+    if import_summary['failed'] or import_summary['pending']:
+        import_error = next((operation['error'] for operation in import_summary['operations'].values() if 'error' in operation), None)
+        reason = (f'Imports of batch into {fhir_version} stores: {import_summary["failed"]} failed, '
+                  f'{import_summary["pending"]} still running after {import_timeout}s')
+        report_failure({
+            'status': 'failure',
+            'reason': reason,
+            'exc': json.dumps(import_error) if import_error else '',
+            'status_code': 500,
+            'path': batch_prefix.rstrip('/'),
+        })
+        # Shards no import is still reading are staged again by the retry.
+        if not import_summary['pending']:
+            delete_staged_files(storage_client, shard_uris)
+        raise RuntimeError(reason)
+
+    # Remove the batched copies that were imported, so a later flush of the same window doesn't repeat them.
+    for batch_blob in batch_blobs:
+        dedup_entry = (batch_blob.metadata or {}).get('dedup_entry')
+        if batch_blob.name in unread:
+            print(f'{batch_blob.name} was not fully read; leaving {dedup_entry or "its deduplication entry"} unconfirmed.')
+        else:
+            confirm_dedup_entry(dedup_entry)
+        try:
+            batch_blob.delete(if_generation_match=batch_blob.generation)
+        except (exceptions.NotFound, exceptions.PreconditionFailed):
+            pass
+    delete_staged_files(storage_client, shard_uris)
 
+    return {'result': 'success', 'files': len(batch_blobs), 'resources': staged_count}
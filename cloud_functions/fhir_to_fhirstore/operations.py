@@ -0,0 +1,129 @@
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from googleapiclient import errors
+from ratelimit import limited_call
+
+# Get the current state of a long-running Healthcare API operation.
+# Returns: operation dict
+def get_operation(hc_client, operation_name):
+    request = (
+        hc_client.projects()
+        .locations()
+        .datasets()
+        .operations()
+        .get(name=operation_name)
+    )
+    response = limited_call('healthcare', request.execute)
+
+    return response
+
+# Seconds between an operation's createTime and endTime, if the metadata has both.
+# Returns: float seconds or None
+def operation_latency(operation):
+    metadata = operation.get('metadata', {})
+    try:
+        create_time = datetime.fromisoformat(metadata['createTime'].replace('Z', '+00:00'))
+        end_time = datetime.fromisoformat(metadata['endTime'].replace('Z', '+00:00'))
+    except (KeyError, ValueError):
+        return None
+
+    return (end_time - create_time).total_seconds()
+
+# Poll outstanding operations concurrently until they are all done or the timeout passes.
+# The wait between rounds doubles up to max_delay, with full jitter so many callers don't poll in step.
+# Errors while polling (e.g. 429) leave the operation pending for the next round.
+# Returns: dict with
+#   total, done, succeeded, failed, pending: int counts
+#   operations: dict of operation name to the last operation dict seen
+#   latency: dict of operation name to seconds from start to completion
+def wait_for_operations(hc_client, operation_names, timeout=300, initial_delay=1.0, max_delay=30.0, max_workers=8):
+    start = time.monotonic()
+    operation_names = list(dict.fromkeys(operation_names))
+    pending = list(operation_names)
+    operations = {}
+    latency = {}
+    delay = initial_delay
+
+    def poll(operation_name):
+        try:
+            return operation_name, get_operation(hc_client, operation_name)
+        except errors.HttpError as exc:
+            print(f'Failed to poll {operation_name}. {exc.resp["status"]}')
+            return operation_name, None
+
+    while pending:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pending)))) as executor:
+            results = list(executor.map(poll, pending))
+
+        pending = []
+        for operation_name, operation in results:
+            if operation is not None:
+                operations[operation_name] = operation
+            if operation is not None and operation.get('done'):
+                latency[operation_name] = operation_latency(operation) or time.monotonic() - start
+            else:
+                pending.append(operation_name)
+
+        elapsed = time.monotonic() - start
+        if not pending or elapsed >= timeout:
+            break
+        time.sleep(min(random.uniform(0, delay), timeout - elapsed))
+        delay = min(delay * 2, max_delay)
+
+    failed = [name for name in latency if 'error' in operations[name]]
+
+    return {
+        'total': len(operation_names),
+        'done': len(latency),
+        'succeeded': len(latency) - len(failed),
+        'failed': len(failed),
+        'pending': len(pending),
+        'operations': operations,
+        'latency': latency,
+    }
+
+# Write one structured log line per tracked import so Cloud Logging can turn
+# import latency per file and per site into log-based metrics.
+# Returns: None
+def log_import_metrics(file_uri, hpo_site, fhir_version, summary, file_size=None):
+    for operation_name, operation in summary['operations'].items():
+        counter = operation.get('metadata', {}).get('counter', {})
+        print(json.dumps({
+            'metric': 'fhir_import',
+            'method': 'import',
+            'file': file_uri,
+            'site': hpo_site,
+            'fhir_version': fhir_version,
+            'operation': operation_name,
+            'file_size': int(file_size) if file_size is not None else None,
+            'done': bool(operation.get('done')),
+            'succeeded': bool(operation.get('done')) and 'error' not in operation,
+            'latency_seconds': summary['latency'].get(operation_name),
+            'resources_succeeded': int(counter.get('success', 0)),
+            'resources_failed': int(counter.get('failure', 0)),
+        }))
+
+    print(f'Imports for {file_uri}: {summary["succeeded"]} succeeded, {summary["failed"]} failed, '
+          f'{summary["pending"]} still running of {summary["total"]}.')
+
+# Log a small file written directly with executeBundle in the same shape as the import metrics,
+# so latency by file size can be compared between the two paths (see FAST_PATH_MAX_BYTES).
+# Returns: None
+def log_execute_metrics(file_uri, hpo_site, fhir_version, resource_path, file_size, entry_count, latency_seconds, succeeded):
+    print(json.dumps({
+        'metric': 'fhir_import',
+        'method': 'execute_bundle',
+        'file': file_uri,
+        'site': hpo_site,
+        'fhir_version': fhir_version,
+        'store': resource_path,
+        'file_size': int(file_size),
+        'done': True,
+        'succeeded': succeeded,
+        'latency_seconds': latency_seconds,
+        'resources_succeeded': entry_count if succeeded else 0,
+        'resources_failed': 0 if succeeded else entry_count,
+    }))
@@ -0,0 +1,240 @@
+import argparse
+import importlib.util
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from error_handler import flush_failures
+from ratelimit import log_limiter_stats
+from task_producer import set_task_sink
+from backfill import list_file_groups, parse_uri
+from main import fhir_to_fhirstore
+
+# In-process pipeline: import_fhir, fhir_to_fhirstore and identify_fhir run in one process as
+# consumers of bounded in-memory queues, instead of being chained by Cloud Tasks and HTTP.
+# The stages are the deployed entry points themselves; the task sink in task_producer hands each
+# task they enqueue to the next stage's queue, chosen by the function name at the end of its url.
+#
+#   python pipeline.py gs://bucket/prefix/ [--import-workers 4] [--fhir-workers 8] [--identify-workers 16]
+#
+# A full queue blocks the stage putting into it, so a slow stage holds back the ones before it
+# instead of buffering without bound. Each stage's queue depth, busy workers and the time spent
+# blocked putting into it are logged as pipeline_stage lines every --report-interval seconds.
+# All stages share the process's clients and Healthcare API rate limiter.
+
+CLOUD_FUNCTIONS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Load another Cloud Function's main.py under its own module name, so it can coexist with this
+# directory's main, which is imported as main (as backfill does) and used as it is.
+# Its directory goes after this one on sys.path: the shared modules are identical copies, and
+# the ones only it has (dedup, batching, ...) are found there.
+# Returns: module
+def load_function(function_dir):
+    path = os.path.join(CLOUD_FUNCTIONS_DIR, function_dir)
+    if path not in sys.path:
+        sys.path.append(path)
+    spec = importlib.util.spec_from_file_location(f'{function_dir}_main', os.path.join(path, 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+# Returns: dict stage with its bounded queue and counters
+def new_stage(name, handler, workers, max_queued):
+    return {
+        'name': name,
+        'handler': handler,
+        'workers': workers,
+        'queue': queue.Queue(maxsize=max_queued),
+        'threads': [],
+        'lock': threading.Lock(),
+        'counts': Counter(),
+        'busy': 0,
+        'blocked_seconds': 0.0,
+    }
+
+# Put an item on the stage's queue, waiting while it is full; the wait is counted as backpressure.
+# Returns: None
+def stage_put(stage, item):
+    start = time.monotonic()
+    stage['queue'].put(item)
+    with stage['lock']:
+        stage['blocked_seconds'] += time.monotonic() - start
+
+# Whether a stage's result reports a failure, the way backfill_file classifies results: the
+# entry points return failure reports (dicts without a success result) or 'Failed ...' and
+# 'Bad request' messages rather than raising, so Cloud Tasks doesn't retry them.
+# Returns: bool
+def result_failed(result):
+    if isinstance(result, dict):
+        return result.get('result') != 'success'
+    if isinstance(result, str):
+        return result.startswith(('Failed', 'Bad request'))
+
+    return False
+
+# Take items off the stage's queue until a None arrives. As Cloud Tasks would, an item whose
+# handler raises is tried again, up to retries times, before it is counted as failed.
+# Returns: None
+def stage_worker(stage, retries):
+    while True:
+        item = stage['queue'].get()
+        if item is None:
+            stage['queue'].task_done()
+            return
+        with stage['lock']:
+            stage['busy'] += 1
+        status = 'failed'
+        for attempt in range(retries + 1):
+            try:
+                result = stage['handler'](item)
+                if result_failed(result):
+                    print(f'{stage["name"]} reported a failure. {result}')
+                else:
+                    status = 'done'
+                break
+            except Exception as exc:
+                print(f'{stage["name"]} failed (attempt {attempt + 1} of {retries + 1}). {type(exc).__name__}: {exc}')
+                time.sleep(min(2 ** attempt, 30))
+        with stage['lock']:
+            stage['busy'] -= 1
+            stage['counts'][status] += 1
+        stage['queue'].task_done()
+
+# Returns: None
+def start_stage(stage, retries):
+    for _ in range(stage['workers']):
+        thread = threading.Thread(target=stage_worker, args=(stage, retries), daemon=True)
+        thread.start()
+        stage['threads'].append(thread)
+
+# Wait for the stage's queue to drain, then stop its workers.
+# Returns: None
+def stop_stage(stage):
+    stage['queue'].join()
+    for _ in stage['threads']:
+        stage['queue'].put(None)
+    for thread in stage['threads']:
+        thread.join()
+
+# Returns: dict of the stage's queue depth, busy workers, items done and failed, and backpressure
+def stage_stats(stage):
+    with stage['lock']:
+        return {
+            'stage': stage['name'],
+            'queued': stage['queue'].qsize(),
+            'max_queued': stage['queue'].maxsize,
+            'busy': stage['busy'],
+            'workers': stage['workers'],
+            'done': stage['counts']['done'],
+            'failed': stage['counts']['failed'],
+            'blocked_seconds': round(stage['blocked_seconds'], 1),
+        }
+
+# Log every stage's stats each interval seconds until stopped; failure reports are sent as it goes.
+# Returns: None
+def report_stages(stages, interval, stopped):
+    while not stopped.wait(interval):
+        for stage in stages:
+            print(json.dumps({'metric': 'pipeline_stage', **stage_stats(stage)}))
+        flush_failures()
+
+# Build the three stages and the task sink that connects them.
+# Returns: list of stages, in pipeline order
+def build_stages(import_workers, fhir_workers, identify_workers, max_queued):
+    import_fhir = load_function('import_fhir')
+    identify_fhir = load_function('identify_fhir')
+
+    stages = [
+        new_stage('import_fhir', lambda event: import_fhir.import_fhir(event, None), import_workers, max_queued),
+        new_stage('fhir_to_fhirstore', lambda body: fhir_to_fhirstore(SimpleNamespace(data=body)),
+                  fhir_workers, max_queued),
+        new_stage('identify_fhir', lambda body: identify_fhir.identify_fhir(SimpleNamespace(data=body)),
+                  identify_workers, max_queued),
+    ]
+    stages_by_function = {
+        os.environ['FHIR_IMPORT_FUNCTION']: stages[1],
+        os.environ['FHIR_IDENTIFY_FUNCTION']: stages[2],
+    }
+
+    def sink(parent, task):
+        function_name = task['http_request']['url'].rstrip('/').split('/')[-1]
+        if function_name not in stages_by_function:
+            raise ValueError(f'No pipeline stage for task to {task["http_request"]["url"]}')
+        stage_put(stages_by_function[function_name], task['http_request'].get('body', b''))
+        return task
+
+    set_task_sink(sink)
+    return stages
+
+# Run every FHIR file under the uri through the three stages in this process.
+# Returns: list of final stage stats
+def run_pipeline(uri, import_workers, fhir_workers, identify_workers, max_queued,
+                 sites=None, versions=None, retries=2, report_interval=30):
+    # Tasks are delivered as soon as they are enqueued, so there is no window for micro-batches
+    # to fill, and there are no per-site queues to route through.
+    os.environ.update(IMPORT_BATCH_MODE='', SITE_QUEUES='shared')
+    os.environ.setdefault('FHIR_IMPORT_FUNCTION', 'fhir_to_fhirstore')
+    os.environ.setdefault('FHIR_IDENTIFY_FUNCTION', 'identify_fhir')
+
+    stages = build_stages(import_workers, fhir_workers, identify_workers, max_queued)
+    for stage in stages:
+        start_stage(stage, retries)
+    stopped = threading.Event()
+    reporter = threading.Thread(target=report_stages, args=(stages, report_interval, stopped), daemon=True)
+    reporter.start()
+
+    start = time.monotonic()
+    bucket_name, prefix = parse_uri(uri)
+    files = 0
+    try:
+        for group_files in list_file_groups(bucket_name, prefix, sites, versions).values():
+            for event in group_files:
+                stage_put(stages[0], event)
+                files += 1
+
+        # A stage is finished once its queue is empty and everything before it has finished.
+        for stage in stages:
+            stop_stage(stage)
+    finally:
+        stopped.set()
+        set_task_sink(None)
+        log_limiter_stats()
+        flush_failures()
+
+    elapsed = time.monotonic() - start
+    stats = [ stage_stats(stage) for stage in stages ]
+    for stage in stats:
+        print(json.dumps({'metric': 'pipeline_stage', **stage}))
+    print(json.dumps({'metric': 'pipeline', 'uri': uri, 'files': files, 'elapsed_seconds': round(elapsed, 1),
+                      'files_per_second': round(files / elapsed, 2) if elapsed else 0}))
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the import, load and identify stages in one process.')
+    parser.add_argument('uri', help='gs://bucket/prefix of the FHIR files to import')
+    parser.add_argument('--sites', nargs='+', help='only import these HPO sites')
+    parser.add_argument('--versions', nargs='+', help="only import these FHIR versions ('unknown' if the path names none)")
+    parser.add_argument('--import-workers', type=int, default=int(os.environ.get('PIPELINE_IMPORT_WORKERS', 4)),
+                        help='import_fhir workers (default: PIPELINE_IMPORT_WORKERS or 4)')
+    parser.add_argument('--fhir-workers', type=int, default=int(os.environ.get('PIPELINE_FHIR_WORKERS', 8)),
+                        help='fhir_to_fhirstore workers (default: PIPELINE_FHIR_WORKERS or 8)')
+    parser.add_argument('--identify-workers', type=int, default=int(os.environ.get('PIPELINE_IDENTIFY_WORKERS', 16)),
+                        help='identify_fhir workers (default: PIPELINE_IDENTIFY_WORKERS or 16)')
+    parser.add_argument('--queue-size', type=int, default=int(os.environ.get('PIPELINE_QUEUE_SIZE', 100)),
+                        help='items each stage queue holds before producers wait (default: PIPELINE_QUEUE_SIZE or 100)')
+    parser.add_argument('--retries', type=int, default=2, help='times a failed item is tried again')
+    parser.add_argument('--report-interval', type=float, default=30, help='seconds between stage stats lines')
+    args = parser.parse_args()
+
+    stats = run_pipeline(args.uri, args.import_workers, args.fhir_workers, args.identify_workers, args.queue_size,
+                         args.sites, args.versions, args.retries, args.report_interval)
+
+    return 1 if any(stage['failed'] for stage in stats) else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
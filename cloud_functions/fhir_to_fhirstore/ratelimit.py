@@ -0,0 +1,130 @@
+import json
+import os
+import random
+import threading
+import time
+
+# Process-wide adaptive rate limiters, one per upstream API, keyed by name.
+# Each is a token bucket whose rate follows AIMD: every success adds LIMITER_INCREASE
+# requests per second spread over a second of traffic, and a 429 or 503 halves it
+# (at most once per LIMITER_COOLDOWN seconds, so one burst of throttling counts once).
+# Throttled calls are retried here, after backing off, instead of failing the whole task.
+_limiters = {}
+_lock = threading.Lock()
+
+THROTTLE_STATUSES = (429, 503)
+
+# Returns: limiter state dict for name, created on first use
+def get_limiter(name):
+    with _lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            rate = float(os.environ.get('LIMITER_RATE', 50))
+            limiter = {
+                'lock': threading.Lock(),
+                'rate': rate,
+                'min_rate': float(os.environ.get('LIMITER_MIN_RATE', 1)),
+                'max_rate': float(os.environ.get('LIMITER_MAX_RATE', 200)),
+                'increase': float(os.environ.get('LIMITER_INCREASE', 5)),
+                'cooldown': float(os.environ.get('LIMITER_COOLDOWN', 1)),
+                'tokens': rate,
+                'updated': time.monotonic(),
+                'decreased': 0.0,
+                'succeeded': 0,
+                'throttled': 0,
+                'decreases': 0,
+                'retries': 0,
+                'waited': 0.0,
+            }
+            _limiters[name] = limiter
+
+    return limiter
+
+# Take a token, sleeping until one is available at the current rate.
+# Returns: float seconds waited
+def acquire(name):
+    limiter = get_limiter(name)
+    waited = 0.0
+    while True:
+        with limiter['lock']:
+            now = time.monotonic()
+            limiter['tokens'] = min(limiter['rate'], limiter['tokens'] + (now - limiter['updated']) * limiter['rate'])
+            limiter['updated'] = now
+            if limiter['tokens'] >= 1:
+                limiter['tokens'] -= 1
+                limiter['waited'] += waited
+                return waited
+            delay = (1 - limiter['tokens']) / limiter['rate']
+        time.sleep(delay)
+        waited += delay
+
+# Adjust the rate after a call: additive increase on success, multiplicative decrease when throttled.
+# A throttled call that will be retried is counted as a retry.
+# Returns: None
+def record(name, throttled, retrying=False):
+    limiter = get_limiter(name)
+    with limiter['lock']:
+        if not throttled:
+            limiter['succeeded'] += 1
+            limiter['rate'] = min(limiter['max_rate'], limiter['rate'] + limiter['increase'] / limiter['rate'])
+            return
+        limiter['throttled'] += 1
+        if retrying:
+            limiter['retries'] += 1
+        now = time.monotonic()
+        if now - limiter['decreased'] >= limiter['cooldown']:
+            limiter['rate'] = max(limiter['min_rate'], limiter['rate'] / 2)
+            limiter['tokens'] = min(limiter['tokens'], 0.0)
+            limiter['decreased'] = now
+            limiter['decreases'] += 1
+
+# Get the HTTP status of a result or error from googleapiclient (HttpError) or requests (Response, HTTPError).
+# Returns: int status code or None
+def _status(result):
+    resp = getattr(result, 'resp', None)
+    if resp is not None and hasattr(resp, 'status'):
+        return resp.status
+    response = getattr(result, 'response', None)
+    if response is not None and hasattr(response, 'status_code'):
+        return response.status_code
+
+    return getattr(result, 'status_code', None)
+
+# Call func under the named limiter. A 429 or 503, raised or returned, slows the limiter down and
+# is retried up to LIMITER_RETRIES times with jittered exponential backoff; the last one is
+# raised or returned as before so the task is still retried by Cloud Tasks.
+# Returns: the result of func
+def limited_call(name, func, *args, **kwargs):
+    retries = int(os.environ.get('LIMITER_RETRIES', 3))
+    for attempt in range(retries + 1):
+        acquire(name)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            if _status(exc) not in THROTTLE_STATUSES:
+                raise
+            record(name, True, attempt < retries)
+            if attempt == retries:
+                raise
+        else:
+            throttled = _status(result) in THROTTLE_STATUSES
+            record(name, throttled, attempt < retries)
+            if not throttled or attempt == retries:
+                return result
+        time.sleep(random.uniform(0, min(30.0, 0.5 * 2 ** attempt)))
+
+# Returns: dict of limiter name to its current rate and counts
+def limiter_stats():
+    with _lock:
+        limiters = dict(_limiters)
+
+    return {
+        name: {key: value for key, value in limiter.items() if key not in ('lock', 'tokens', 'updated', 'decreased')}
+        for name, limiter in limiters.items()
+    }
+
+# Write one structured log line per limiter so Cloud Logging can chart rates and throttling.
+# Returns: None
+def log_limiter_stats():
+    for name, stats in limiter_stats().items():
+        print(json.dumps({'metric': 'rate_limiter', 'limiter': name, **stats}))
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+from googleapiclient import errors
+from clients import get_storage_client
+from fhir_funcs import create_fhir_dataset, create_fhir_store
+
+# Datasets and FHIR stores already confirmed to exist, keyed by full resource name,
+# with the time they were confirmed. Entries expire after STORE_CACHE_TTL seconds.
+# If STORE_MANIFEST_URI (gs://bucket/path.json) is set, confirmations are also kept in
+# that object so new instances start with what other instances already know.
+_known = {}
+_lock = threading.Lock()
+
+# Returns: (bucket name, object name) of the manifest or None if not configured
+def _manifest_location():
+    manifest_uri = os.environ.get('STORE_MANIFEST_URI')
+    if not manifest_uri:
+        return None
+    bucket_name, _, blob_name = manifest_uri.removeprefix('gs://').partition('/')
+
+    return bucket_name, blob_name
+
+# Read the manifest of confirmed resources.
+# Returns: dict of resource name to confirmed time
+def _read_manifest():
+    location = _manifest_location()
+    if location is None:
+        return {}
+    blob = get_storage_client().bucket(location[0]).blob(location[1])
+    try:
+        return json.loads(blob.download_as_text())
+    except Exception as exc:
+        print(f'Store manifest not read. {exc}')
+        return {}
+
+# Write the confirmed resources that have not expired to the manifest.
+# Concurrent writers may drop each other's entries; that only costs an extra create call.
+# Returns: None
+def _write_manifest(known):
+    location = _manifest_location()
+    if location is None:
+        return
+    blob = get_storage_client().bucket(location[0]).blob(location[1])
+    try:
+        blob.upload_from_string(json.dumps(known), content_type='application/json')
+    except Exception as exc:
+        print(f'Store manifest not written. {exc}')
+
+# Drop expired entries.
+# Returns: dict of resource name to confirmed time
+def _unexpired(known):
+    ttl = int(os.environ.get('STORE_CACHE_TTL', 3600))
+    now = time.time()
+
+    return {name: confirmed for name, confirmed in known.items() if now - confirmed < ttl}
+
+# Determine if a dataset or store was confirmed within the TTL.
+# Returns: bool
+def is_known(name):
+    with _lock:
+        if name in _unexpired(_known):
+            return True
+
+    if _manifest_location() is None:
+        return False
+
+    manifest = _unexpired(_read_manifest())
+    with _lock:
+        _known.update(manifest)
+
+    return name in manifest
+
+# Record that a dataset or store exists.
+# Returns: None
+def confirm(name):
+    with _lock:
+        _known[name] = time.time()
+
+    if _manifest_location() is not None:
+        manifest = _unexpired(_read_manifest())
+        manifest[name] = time.time()
+        _write_manifest(manifest)
+
+# Forget a dataset or store, e.g. after deleting it. Forgetting a dataset also forgets its stores.
+# Returns: None
+def invalidate(name):
+    def keep(known):
+        return {known_name: confirmed for known_name, confirmed in known.items()
+                if known_name != name and not known_name.startswith(f'{name}/')}
+
+    with _lock:
+        remaining = keep(_known)
+        _known.clear()
+        _known.update(remaining)
+
+    if _manifest_location() is not None:
+        _write_manifest(keep(_unexpired(_read_manifest())))
+
+# Create the FHIR dataset unless it is already known to exist.
+# Returns: bool True if the create call was made
+def ensure_fhir_dataset(hc_client, dataset_id, dataset_parent):
+    dataset_name = f'{dataset_parent}/datasets/{dataset_id}'
+    if is_known(dataset_name):
+        return False
+
+    try:
+        create_fhir_dataset(hc_client, dataset_id, dataset_parent)
+        print(f'Created FHIR dataset: {dataset_id}')
+        confirm(dataset_name)
+    except errors.HttpError as exc:
+        print(f'FHIR dataset {dataset_id} exists already. {exc.resp["status"]}')
+        if exc.resp.status == 409:
+            confirm(dataset_name)
+
+    return True
+
+# Create the FHIR store unless it is already known to exist.
+# Returns: bool True if the create call was made
+def ensure_fhir_store(hc_client, fhir_version, fhir_store_id, fhir_store_parent):
+    fhir_store_name = f'{fhir_store_parent}/fhirStores/{fhir_store_id}'
+    if is_known(fhir_store_name):
+        return False
+
+    try:
+        create_fhir_store(hc_client, fhir_version, fhir_store_id, fhir_store_parent)
+        print(f'Created FHIR store: {fhir_store_id}')
+        confirm(fhir_store_name)
+    except errors.HttpError as exc:
+        print(f'FHIR store {fhir_store_id} exists already. {exc.resp["status"]}')
+        if exc.resp.status == 409:
+            confirm(fhir_store_name)
+
+    return True
@@ -0,0 +1,64 @@
+import copy
+
+from fhir_funcs import enrich_resources, merge_identifiers
+from utils import build_identifiers, identifier_system
+
+ID_LIST = build_identifiers('bucket/collection/a/b/c/Epic/SiteA/P1/file.json/1')
+
+
+def test_merging_twice_changes_nothing_the_second_time():
+    resource = {'resourceType': 'Patient', 'id': 'p1', 'identifier': [{'system': 'urn:mrn', 'value': '42'}]}
+
+    assert merge_identifiers(resource, ID_LIST)
+    merged = copy.deepcopy(resource)
+    assert not merge_identifiers(resource, ID_LIST)
+
+    assert resource == merged
+    assert resource['identifier'] == [{'system': 'urn:mrn', 'value': '42'}] + ID_LIST
+
+
+def test_legacy_values_are_replaced_by_their_system_form():
+    resource = {'resourceType': 'Patient', 'id': 'p1', 'identifier': [
+        {'value': 'HPO Site: SiteA'},
+        {'value': 'Participant ID: P1'},
+        {'system': 'urn:mrn', 'value': '42'},
+    ]}
+
+    assert merge_identifiers(resource, ID_LIST)
+
+    assert resource['identifier'] == [{'system': 'urn:mrn', 'value': '42'}] + ID_LIST
+    assert {'system': identifier_system('hpo-site'), 'value': 'SiteA'} in resource['identifier']
+
+
+def test_legacy_values_alone_still_count_as_a_change():
+    resource = {'resourceType': 'Patient', 'id': 'p1', 'identifier': ID_LIST + [{'value': 'HPO Site: SiteA'}]}
+
+    assert merge_identifiers(resource, ID_LIST)
+    assert resource['identifier'] == ID_LIST
+
+
+def test_single_valued_identifier_is_left_alone():
+    resource = {'resourceType': 'Bundle', 'id': 'b1', 'identifier': {'system': 'urn:bundle', 'value': '7'}}
+
+    assert not merge_identifiers(resource, ID_LIST)
+    assert resource['identifier'] == {'system': 'urn:bundle', 'value': '7'}
+
+
+def test_resource_that_already_has_the_identifiers_is_unchanged():
+    resource = {'resourceType': 'Patient', 'id': 'p1', 'identifier': copy.deepcopy(ID_LIST)}
+
+    assert not merge_identifiers(resource, ID_LIST)
+    assert resource['identifier'] == ID_LIST
+
+
+def test_enrich_resources_drops_unchanged_resources_when_asked():
+    resources = [
+        {'resourceType': 'Patient', 'id': 'p1'},
+        {'resourceType': 'Patient', 'id': 'p2', 'identifier': copy.deepcopy(ID_LIST)},
+    ]
+    counts = {}
+
+    enriched = list(enrich_resources(resources, ID_LIST, changed_only=True, counts=counts))
+
+    assert [resource['id'] for resource in enriched] == ['p1']
+    assert counts == {'unchanged': 1}
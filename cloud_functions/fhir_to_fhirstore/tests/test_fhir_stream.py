@@ -0,0 +1,103 @@
+import io
+import json
+import random
+
+import pytest
+
+from fhir_stream import iter_fhir_entries, iter_resources
+
+
+def parse(text, chunk_size=1024 * 1024):
+    header = {}
+    entries = list(iter_fhir_entries(io.StringIO(text), header, chunk_size))
+    return entries, header
+
+
+def bundle(count):
+    return {
+        'resourceType': 'Bundle',
+        'type': 'transaction',
+        'entry': [ {'resource': {'resourceType': 'Patient', 'id': f'p{i}', 'value': 12345.678}} for i in range(count) ],
+        'meta': {'lastUpdated': '2024-01-01'},
+    }
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1024 * 1024])
+def test_bundle_entries_are_streamed_across_chunks(chunk_size):
+    document = bundle(5)
+    entries, header = parse(json.dumps(document, indent=2), chunk_size)
+
+    assert entries == document['entry']
+    assert header == {'resourceType': 'Bundle', 'type': 'transaction', 'meta': {'lastUpdated': '2024-01-01'}}
+
+
+def test_single_resource_is_yielded_whole():
+    document = {'resourceType': 'Patient', 'id': 'p1', 'name': [{'family': 'Doe'}]}
+    entries, header = parse(json.dumps(document))
+
+    assert entries == [{'resource': document}]
+    assert header == document
+
+
+def test_list_keeps_its_entry_member():
+    document = {'resourceType': 'List', 'id': 'l1', 'status': 'current',
+                'entry': [{'item': {'reference': 'Patient/p1'}}, {'item': {'reference': 'Patient/p2'}}]}
+    entries, header = parse(json.dumps(document))
+
+    assert list(iter_resources(entries)) == [document]
+    assert header['entry'] == document['entry']
+
+
+def test_bundle_with_entry_before_resource_type():
+    document = {'entry': [{'resource': {'resourceType': 'Patient', 'id': 'p1'}}], 'resourceType': 'Bundle'}
+    entries, header = parse(json.dumps(document), chunk_size=5)
+
+    assert entries == document['entry']
+    assert 'entry' not in header
+
+
+def test_empty_bundle_and_empty_entry():
+    assert parse('{"resourceType": "Bundle", "entry": []}') == ([], {'resourceType': 'Bundle'})
+    assert parse('{"resourceType": "Bundle"}') == ([], {'resourceType': 'Bundle'})
+    assert parse('{}') == ([{'resource': {}}], {})
+
+
+@pytest.mark.parametrize('chunk_size', range(1, 70))
+def test_numbers_split_across_chunks(chunk_size):
+    document = {'resourceType': 'ChargeItem', 'factorOverride': 0.8, 'priceOverride': 1.5e3,
+                'quantity': -12, 'weight': 2.25E-4, 'count': 100, 'id': 'x'}
+    entries, header = parse(json.dumps(document), chunk_size)
+
+    assert entries == [{'resource': document}]
+    assert header == document
+
+
+def test_numbers_split_at_random_chunk_boundaries():
+    rng = random.Random(9)
+    for _ in range(200):
+        document = {'resourceType': 'Observation', 'id': 'o1'}
+        for i in range(rng.randint(1, 6)):
+            document[f'value{i}'] = rng.choice([rng.uniform(-1e6, 1e6), rng.uniform(0, 1), rng.randint(-10 ** 9, 10 ** 9),
+                                                float(f'{rng.random():.3f}e{rng.randint(-30, 30)}')])
+        entries, header = parse(json.dumps(document), rng.randint(1, 40))
+
+        assert header == document
+
+
+@pytest.mark.parametrize('text', [
+    '{"a":1 "b":2}',
+    '{"resourceType": "Bundle", "entry": [{} {}]}',
+    '{"resourceType": "Patient"} trailing',
+    '{"resourceType": "Patient"}{}',
+    '{"resourceType": "Patient",}',
+    '{,"resourceType": "Patient"}',
+    '{"resourceType": "Bundle", "entry": [{},]}',
+    '{"resourceType": "Bundle", "entry": [{}',
+    '{"resourceType": "Patient"',
+    '{1: 2}',
+    '[]',
+    '',
+])
+def test_malformed_documents_are_rejected(text):
+    with pytest.raises(json.decoder.JSONDecodeError):
+        parse(text, chunk_size=4)
@@ -0,0 +1,98 @@
+import pytest
+
+import ratelimit
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class ThrottledError(Exception):
+    def __init__(self, status_code):
+        super().__init__(status_code)
+        self.response = Response(status_code)
+
+
+@pytest.fixture(autouse=True)
+def limiters(monkeypatch):
+    monkeypatch.setattr(ratelimit, '_limiters', {})
+    monkeypatch.setattr(ratelimit.time, 'sleep', lambda seconds: None)
+    monkeypatch.setenv('LIMITER_RATE', '100')
+    monkeypatch.setenv('LIMITER_COOLDOWN', '0')
+    monkeypatch.setenv('LIMITER_RETRIES', '3')
+
+
+def statuses(*codes):
+    codes = list(codes)
+
+    def call():
+        return Response(codes.pop(0))
+
+    return call
+
+
+def test_returned_429s_are_retried_and_halve_the_rate():
+    call = statuses(429, 429, 200)
+
+    assert ratelimit.limited_call('api', call).status_code == 200
+    limiter = ratelimit.get_limiter('api')
+    assert limiter['throttled'] == 2
+    assert limiter['retries'] == 2
+    assert limiter['succeeded'] == 1
+    assert limiter['decreases'] == 2
+    assert limiter['rate'] < 100 / 4 + 1
+
+
+def test_raised_throttling_is_raised_after_the_last_retry():
+    def call():
+        raise ThrottledError(503)
+
+    with pytest.raises(ThrottledError):
+        ratelimit.limited_call('api', call)
+    limiter = ratelimit.get_limiter('api')
+    assert limiter['throttled'] == 4
+    assert limiter['retries'] == 3
+
+
+def test_last_throttled_response_is_returned():
+    assert ratelimit.limited_call('api', statuses(429, 429, 429, 429)).status_code == 429
+    assert ratelimit.get_limiter('api')['retries'] == 3
+
+
+def test_other_errors_are_not_retried():
+    def call():
+        raise ThrottledError(400)
+
+    with pytest.raises(ThrottledError):
+        ratelimit.limited_call('api', call)
+    limiter = ratelimit.get_limiter('api')
+    assert limiter['throttled'] == 0
+    assert limiter['retries'] == 0
+
+
+def test_rate_never_drops_below_the_minimum(monkeypatch):
+    monkeypatch.setenv('LIMITER_MIN_RATE', '10')
+    for _ in range(20):
+        ratelimit.record('api', True)
+
+    assert ratelimit.get_limiter('api')['rate'] == 10
+
+
+def test_acquire_waits_for_tokens_at_the_current_rate(monkeypatch):
+    slept = []
+    monkeypatch.setattr(ratelimit.time, 'sleep', slept.append)
+    monkeypatch.setenv('LIMITER_RATE', '5')
+    clock = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: clock[0])
+
+    waits = [ ratelimit.acquire('api') for _ in range(5) ]
+    assert waits == [0.0] * 5
+
+    def sleep(seconds):
+        slept.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(ratelimit.time, 'sleep', sleep)
+    assert ratelimit.acquire('api') == pytest.approx(0.2)
+    assert ratelimit.get_limiter('api')['waited'] == pytest.approx(0.2)
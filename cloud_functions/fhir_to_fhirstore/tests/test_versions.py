@@ -0,0 +1,115 @@
+import io
+import json
+
+import pytest
+
+from fhir_stream import iter_fhir_entries
+from indexer import finish_index, index_entries, new_index
+from versions import best_version
+
+# The default VERSION_CONFIDENCE: a detection at or above it skips the trial imports.
+VERSION_CONFIDENCE = 0.8
+
+
+def entry(resource):
+    return {'fullUrl': f'urn:uuid:{resource["id"]}', 'resource': resource, 'request': {'method': 'POST', 'url': resource['resourceType']}}
+
+
+def bundle(*resources):
+    return {'resourceType': 'Bundle', 'type': 'transaction', 'entry': [entry(r) for r in resources]}
+
+
+# Synthea-style transaction bundles of one patient, written the way each version shapes them.
+R4_BUNDLE = bundle(
+    {'resourceType': 'Patient', 'id': 'p1', 'gender': 'female', 'birthDate': '1970-01-01'},
+    {'resourceType': 'Encounter', 'id': 'e1', 'status': 'finished', 'class': {'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'AMB'}, 'subject': {'reference': 'urn:uuid:p1'}},
+    {'resourceType': 'Condition', 'id': 'c1', 'clinicalStatus': {'coding': [{'code': 'active'}]}, 'verificationStatus': {'coding': [{'code': 'confirmed'}]}, 'subject': {'reference': 'urn:uuid:p1'}, 'encounter': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'Observation', 'id': 'o1', 'status': 'final', 'subject': {'reference': 'urn:uuid:p1'}, 'encounter': {'reference': 'urn:uuid:e1'}, 'valueQuantity': {'value': 72.5, 'unit': 'kg'}},
+    {'resourceType': 'MedicationRequest', 'id': 'm1', 'status': 'active', 'intent': 'order', 'subject': {'reference': 'urn:uuid:p1'}, 'encounter': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'Immunization', 'id': 'i1', 'status': 'completed', 'patient': {'reference': 'urn:uuid:p1'}, 'occurrenceDateTime': '2020-01-01T00:00:00Z'},
+    {'resourceType': 'CareTeam', 'id': 't1', 'status': 'active', 'subject': {'reference': 'urn:uuid:p1'}, 'encounter': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'CarePlan', 'id': 'cp1', 'status': 'active', 'intent': 'order', 'subject': {'reference': 'urn:uuid:p1'}, 'encounter': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'Claim', 'id': 'cl1', 'status': 'active', 'type': {'coding': [{'code': 'institutional'}]}, 'patient': {'reference': 'urn:uuid:p1'}},
+)
+STU3_BUNDLE = bundle(
+    {'resourceType': 'Patient', 'id': 'p1', 'gender': 'female', 'birthDate': '1970-01-01'},
+    {'resourceType': 'Encounter', 'id': 'e1', 'status': 'finished', 'class': {'code': 'ambulatory'}, 'subject': {'reference': 'urn:uuid:p1'}},
+    {'resourceType': 'Condition', 'id': 'c1', 'clinicalStatus': 'active', 'verificationStatus': 'confirmed', 'subject': {'reference': 'urn:uuid:p1'}, 'context': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'Observation', 'id': 'o1', 'status': 'final', 'subject': {'reference': 'urn:uuid:p1'}, 'context': {'reference': 'urn:uuid:e1'}, 'valueQuantity': {'value': 72.5, 'unit': 'kg'}},
+    {'resourceType': 'MedicationRequest', 'id': 'm1', 'status': 'active', 'intent': 'order', 'subject': {'reference': 'urn:uuid:p1'}, 'context': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'Immunization', 'id': 'i1', 'status': 'completed', 'notGiven': False, 'patient': {'reference': 'urn:uuid:p1'}, 'date': '2020-01-01T00:00:00Z'},
+    {'resourceType': 'CareTeam', 'id': 't1', 'status': 'active', 'subject': {'reference': 'urn:uuid:p1'}, 'context': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'CarePlan', 'id': 'cp1', 'status': 'active', 'intent': 'order', 'subject': {'reference': 'urn:uuid:p1'}, 'context': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'Claim', 'id': 'cl1', 'status': 'active', 'type': {'coding': [{'code': 'institutional'}]}, 'patient': {'reference': 'urn:uuid:p1'}},
+)
+DSTU2_BUNDLE = bundle(
+    {'resourceType': 'Patient', 'id': 'p1', 'gender': 'female', 'birthDate': '1970-01-01'},
+    {'resourceType': 'Encounter', 'id': 'e1', 'status': 'finished', 'class': 'outpatient', 'patient': {'reference': 'urn:uuid:p1'}},
+    {'resourceType': 'Condition', 'id': 'c1', 'clinicalStatus': 'active', 'verificationStatus': 'confirmed', 'patient': {'reference': 'urn:uuid:p1'}, 'encounter': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'Observation', 'id': 'o1', 'status': 'final', 'subject': {'reference': 'urn:uuid:p1'}, 'encounter': {'reference': 'urn:uuid:e1'}, 'valueQuantity': {'value': 72.5, 'unit': 'kg'}},
+    {'resourceType': 'MedicationOrder', 'id': 'm1', 'status': 'active', 'patient': {'reference': 'urn:uuid:p1'}, 'encounter': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'Immunization', 'id': 'i1', 'status': 'completed', 'wasNotGiven': False, 'reported': False, 'patient': {'reference': 'urn:uuid:p1'}, 'date': '2020-01-01T00:00:00Z'},
+    {'resourceType': 'Goal', 'id': 'g1', 'status': 'in-progress', 'description': 'Lose weight', 'subject': {'reference': 'urn:uuid:p1'}},
+    {'resourceType': 'CarePlan', 'id': 'cp1', 'status': 'active', 'subject': {'reference': 'urn:uuid:p1'}, 'context': {'reference': 'urn:uuid:e1'}},
+    {'resourceType': 'Claim', 'id': 'cl1', 'type': 'institutional', 'patient': {'reference': 'urn:uuid:p1'}},
+)
+AMBIGUOUS_BUNDLE = bundle(
+    {'resourceType': 'Patient', 'id': 'p1', 'gender': 'female', 'birthDate': '1970-01-01'},
+    {'resourceType': 'Observation', 'id': 'o1', 'status': 'final', 'subject': {'reference': 'urn:uuid:p1'}, 'valueQuantity': {'value': 72.5, 'unit': 'kg'}},
+    {'resourceType': 'Encounter', 'id': 'e1', 'status': 'finished', 'class': {'code': 'AMB'}, 'subject': {'reference': 'urn:uuid:p1'}},
+)
+
+
+# Classify a bundle the way fhir_to_fhirstore does: scored while it is streamed and indexed.
+def detect(document):
+    file_index = new_index()
+    header = {}
+    for _ in index_entries(file_index, iter_fhir_entries(io.StringIO(json.dumps(document)), header, chunk_size=64)):
+        pass
+    finish_index(file_index, header)
+
+    return best_version(file_index['version_scores'])
+
+
+@pytest.mark.parametrize('document, version, confidence', [
+    (R4_BUNDLE, 'R4', 0.7),
+    (STU3_BUNDLE, 'STU3', 8.5 / 12),
+    (DSTU2_BUNDLE, 'DSTU2', 7.5 / 9),
+])
+def test_synthea_bundles_are_classified(document, version, confidence):
+    assert detect(document) == (version, pytest.approx(confidence))
+
+
+def test_only_dstu2_is_confident_enough_to_skip_trial_imports():
+    assert detect(DSTU2_BUNDLE)[1] >= VERSION_CONFIDENCE
+    assert detect(R4_BUNDLE)[1] < VERSION_CONFIDENCE
+    assert detect(STU3_BUNDLE)[1] < VERSION_CONFIDENCE
+
+
+def test_ambiguous_bundle_is_not_confident():
+    version, confidence = detect(AMBIGUOUS_BUNDLE)
+
+    assert version in ('R4', 'STU3')
+    assert confidence == pytest.approx(0.5)
+
+
+def test_bundle_without_evidence_is_not_found():
+    document = bundle({'resourceType': 'Patient', 'id': 'p1', 'gender': 'female'})
+
+    assert detect(document) == ('NOT_FOUND', 0.0)
+
+
+@pytest.mark.parametrize('resource_type, fhir_version, version', [
+    ('CapabilityStatement', '4.0.1', 'R4'),
+    ('CapabilityStatement', '3.0.2', 'STU3'),
+    ('Conformance', '1.0.2', 'DSTU2'),
+])
+def test_fhir_version_outweighs_field_shapes(resource_type, fhir_version, version):
+    document = bundle(
+        {'resourceType': resource_type, 'id': 'cs1', 'status': 'active', 'fhirVersion': fhir_version},
+        {'resourceType': 'Encounter', 'id': 'e1', 'status': 'finished', 'class': {'code': 'AMB'}},
+    )
+    detected, confidence = detect(document)
+
+    assert detected == version
+    assert confidence >= VERSION_CONFIDENCE
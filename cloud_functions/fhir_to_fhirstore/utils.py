@@ -1,5 +1,20 @@
+import os
+
+# Kinds of identifier added to each FHIR resource: (label used before systems were added, system suffix).
+IDENTIFIER_KINDS = (
+    ('Collection', 'collection'),
+    ('EHR Platform', 'ehr-platform'),
+    ('HPO Site', 'hpo-site'),
+    ('Participant ID', 'participant'),
+)
+
+# The system URI of an identifier kind, under IDENTIFIER_SYSTEM_BASE.
+# Returns: string URI
+def identifier_system(kind):
+    return os.environ.get('IDENTIFIER_SYSTEM_BASE', 'urn:omop-on-fhir:identifier:') + kind
+
 # Build list of identifiers that are to be added to each FHIR resource.
-# Returns: list
+# Returns: list of identifier dicts with system and value
 def build_identifiers(id_path):
     id_list = []
     file_path = id_path.split('/')
@@ -12,33 +27,20 @@ def build_identifiers(id_path):
         ehr_platform = 'Synthea'
         hpo_site = 'Synthea'
         participant_id = file_path[-1].removesuffix('.json').split('_')[-1]
-    id_list.append(f'Collection: {collection}')  
-    id_list.append(f'EHR Platform: {ehr_platform}')          
-    id_list.append(f'HPO Site: {hpo_site}')
-    id_list.append(f'Participant ID: {participant_id}')
+    id_values = (collection, ehr_platform, hpo_site, participant_id)
+    for (label, kind), value in zip(IDENTIFIER_KINDS, id_values):
+        id_list.append({ "system": identifier_system(kind), "value": value })
         
     return id_list
 
-# Determine if a key exists in a dictionary (possibly nested).
-# Returns: string key value or NOT_FOUND
-def find_by_key(data, target):
-    for key, value in data.items():
-        if isinstance(value, dict):
-            find_by_key(value, target)
-        elif key == target:
-            return value
-        
-    return 'NOT_FOUND'
-
-    
 # Try to determine the FHIR version from the file name or path.
 # Returns: string FHIR version and string FHIR store ID
-def name_resources(file_name, file_json):
+def name_resources(file_name, file_index):
     # Check for:
-    #   FHIRVersion key in json
+    #   FHIRVersion key in json (from the file index)
     #   FHIR specification in file name e.g. resourceid.R4.json
     #   FHIR specification in file path e.g. aou-curation-omop-dev_transfer_fhir/synthea_mg/fhir_dstu2/blah.json
-    fhir_version = find_by_key(file_json, 'FHIRVersion')
+    fhir_version = file_index['fhir_version']
     try:
         hpo_site = file_name.split('/')[6].split(' ')[0]
     except:
@@ -79,3 +81,30 @@ def name_resources(file_name, file_json):
         fhir_store_id = f'fhir-{hpo_site}-{fhir_version}' 
         fhir_store_combined_id = f'fhir-combined-{fhir_version}'
     return fhir_version, fhir_store_id, fhir_store_combined_id, hpo_site   
+
+# Split an iterable into lists of at most size items without materialising it.
+# Returns: generator of lists
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+# Call func once per target concurrently, capturing each target's error separately.
+# Returns: dict of target to (result, exception), in the order of targets
+def fan_out(func, targets, max_workers=None):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def call(target):
+        try:
+            return func(target), None
+        except Exception as exc:
+            return None, exc
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(targets)) as executor:
+        return dict(zip(targets, executor.map(call, targets)))
@@ -0,0 +1,135 @@
+# Content-based FHIR version detection.
+# Each piece of evidence names the versions it is compatible with and carries a weight;
+# the weight is split between those versions, so evidence shared by every version counts
+# for nothing and evidence unique to one version counts in full.
+
+FHIR_VERSIONS = ('R4', 'STU3', 'DSTU2')
+
+# fhirVersion values (CapabilityStatement, Conformance, StructureDefinition, ...) by prefix.
+FHIR_VERSION_PREFIXES = (('4.', 'R4'), ('3.', 'STU3'), ('1.0', 'DSTU2'))
+
+# Version segments used in profile URLs, e.g. http://hl7.org/fhir/R4/StructureDefinition/...
+PROFILE_VERSION_SEGMENTS = (('/R4/', 'R4'), ('/STU3/', 'STU3'), ('/DSTU2/', 'DSTU2'))
+
+# Resource types that do not exist in every version.
+RESOURCE_TYPE_VERSIONS = {
+    'BiologicallyDerivedProduct': ('R4',),
+    'ChargeItemDefinition': ('R4',),
+    'CoverageEligibilityRequest': ('R4',),
+    'CoverageEligibilityResponse': ('R4',),
+    'ImmunizationEvaluation': ('R4',),
+    'InsurancePlan': ('R4',),
+    'Invoice': ('R4',),
+    'MedicationKnowledge': ('R4',),
+    'MolecularSequence': ('R4',),
+    'ServiceRequest': ('R4',),
+    'TerminologyCapabilities': ('R4',),
+    'VerificationResult': ('R4',),
+    'ExpansionProfile': ('STU3',),
+    'ImagingManifest': ('STU3',),
+    'Sequence': ('STU3',),
+    'ServiceDefinition': ('STU3',),
+    'Conformance': ('DSTU2',),
+    'DeviceUseRequest': ('DSTU2',),
+    'DiagnosticOrder': ('DSTU2',),
+    'ImagingObjectSelection': ('DSTU2',),
+    'MedicationOrder': ('DSTU2',),
+    'Order': ('DSTU2',),
+    'OrderResponse': ('DSTU2',),
+    'CapabilityStatement': ('R4', 'STU3'),
+    'CareTeam': ('R4', 'STU3'),
+    'MedicationRequest': ('R4', 'STU3'),
+    'BodySite': ('STU3', 'DSTU2'),
+    'DataElement': ('STU3', 'DSTU2'),
+    'EligibilityRequest': ('STU3', 'DSTU2'),
+    'EligibilityResponse': ('STU3', 'DSTU2'),
+    'ProcedureRequest': ('STU3', 'DSTU2'),
+    'ProcessRequest': ('STU3', 'DSTU2'),
+    'ProcessResponse': ('STU3', 'DSTU2'),
+    'ReferralRequest': ('STU3', 'DSTU2'),
+}
+
+# Field shapes that differ between versions: (resource type, field, shape) -> versions.
+# Shape is 'present', 'str' or 'dict'.
+FIELD_SHAPE_VERSIONS = {
+    ('AllergyIntolerance', 'clinicalStatus', 'dict'): ('R4',),
+    ('AllergyIntolerance', 'clinicalStatus', 'str'): ('STU3',),
+    ('AllergyIntolerance', 'status', 'present'): ('DSTU2',),
+    ('CarePlan', 'context', 'present'): ('STU3',),
+    ('CarePlan', 'encounter', 'present'): ('R4',),
+    ('Claim', 'type', 'str'): ('DSTU2',),
+    ('Claim', 'type', 'dict'): ('R4', 'STU3'),
+    ('Condition', 'clinicalStatus', 'dict'): ('R4',),
+    ('Condition', 'clinicalStatus', 'str'): ('STU3', 'DSTU2'),
+    ('Condition', 'patient', 'present'): ('DSTU2',),
+    ('Condition', 'context', 'present'): ('STU3',),
+    ('DiagnosticReport', 'context', 'present'): ('STU3',),
+    ('Encounter', 'class', 'str'): ('DSTU2',),
+    ('Encounter', 'class', 'dict'): ('R4', 'STU3'),
+    ('Goal', 'description', 'str'): ('DSTU2',),
+    ('Goal', 'description', 'dict'): ('R4', 'STU3'),
+    ('Immunization', 'occurrenceDateTime', 'present'): ('R4',),
+    ('Immunization', 'notGiven', 'present'): ('STU3',),
+    ('Immunization', 'wasNotGiven', 'present'): ('DSTU2',),
+    ('MedicationRequest', 'context', 'present'): ('STU3',),
+    ('MedicationRequest', 'encounter', 'present'): ('R4',),
+    ('Observation', 'context', 'present'): ('STU3',),
+    ('Procedure', 'context', 'present'): ('STU3',),
+}
+
+FHIR_VERSION_WEIGHT = 10.0
+PROFILE_WEIGHT = 5.0
+RESOURCE_TYPE_WEIGHT = 2.0
+FIELD_SHAPE_WEIGHT = 1.0
+
+# Add weighted evidence for the given versions to scores.
+# Returns: None
+def add_evidence(scores, versions, weight):
+    for version in versions:
+        scores[version] = scores.get(version, 0.0) + weight / len(versions)
+
+# Find the version a fhirVersion value belongs to.
+# Returns: string FHIR version or NOT_FOUND
+def version_from_fhir_version(fhir_version):
+    for prefix, version in FHIR_VERSION_PREFIXES:
+        if str(fhir_version).startswith(prefix):
+            return version
+
+    return 'NOT_FOUND'
+
+# Add the version evidence found in one resource to scores.
+# Returns: None
+def score_resource(resource, scores):
+    resource_type = resource.get('resourceType')
+
+    if 'fhirVersion' in resource:
+        fhir_version = version_from_fhir_version(resource['fhirVersion'])
+        if fhir_version != 'NOT_FOUND':
+            add_evidence(scores, (fhir_version,), FHIR_VERSION_WEIGHT)
+
+    meta = resource.get('meta')
+    if isinstance(meta, dict):
+        for profile in meta.get('profile', []):
+            for segment, version in PROFILE_VERSION_SEGMENTS:
+                if segment in str(profile):
+                    add_evidence(scores, (version,), PROFILE_WEIGHT)
+
+    if resource_type in RESOURCE_TYPE_VERSIONS:
+        add_evidence(scores, RESOURCE_TYPE_VERSIONS[resource_type], RESOURCE_TYPE_WEIGHT)
+
+    for field, value in resource.items():
+        shape = 'str' if isinstance(value, str) else 'dict' if isinstance(value, dict) else None
+        for key in ((resource_type, field, 'present'), (resource_type, field, shape)):
+            if key in FIELD_SHAPE_VERSIONS:
+                add_evidence(scores, FIELD_SHAPE_VERSIONS[key], FIELD_SHAPE_WEIGHT)
+
+# Pick the best supported version from the scores.
+# Confidence is the share of all evidence held by that version.
+# Returns: string FHIR version or NOT_FOUND, float confidence
+def best_version(scores):
+    total = sum(scores.values())
+    if total == 0:
+        return 'NOT_FOUND', 0.0
+    version = max(FHIR_VERSIONS, key=lambda fhir_version: scores.get(fhir_version, 0.0))
+
+    return version, scores.get(version, 0.0) / total
@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+
+# Process-wide registry of API clients. Cloud Functions reuse the process between
+# invocations on a warm instance, so clients, credentials and connection pools built
+# here are shared by every later request. Google libraries are imported lazily so each
+# function only needs the dependencies of the clients it actually uses.
+_clients = {}
+_lock = threading.RLock()
+
+# Get a client from the registry, building it with factory on first use.
+# The build time is logged so cold and warm overhead can be compared.
+# Returns: the cached client
+def get_client(key, factory):
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                start = time.perf_counter()
+                client = factory()
+                _clients[key] = client
+                print(f'Initialised {key} client in {(time.perf_counter() - start) * 1000:.1f} ms.')
+
+    return client
+
+# Drop a client from the registry so the next call builds a new one.
+# Returns: None
+def reset_client(key):
+    with _lock:
+        _clients.pop(key, None)
+
+# Returns: google.cloud.storage.Client
+def get_storage_client():
+    def build():
+        from google.cloud import storage
+        return storage.Client()
+
+    return get_client('storage', build)
+
+# Returns: google.cloud.tasks_v2.CloudTasksClient
+def get_tasks_client():
+    def build():
+        from google.cloud import tasks_v2
+        return tasks_v2.CloudTasksClient()
+
+    return get_client('tasks', build)
+
+# Messages are batched in the background: a batch is sent once it is PUBLISH_MAX_LATENCY seconds old
+# or holds PUBLISH_MAX_MESSAGES messages or PUBLISH_MAX_BYTES bytes, whichever comes first.
+# Returns: google.cloud.pubsub_v1.PublisherClient
+def get_publisher_client():
+    def build():
+        from google.cloud import pubsub_v1
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_bytes=int(os.environ.get('PUBLISH_MAX_BYTES', 1000000)),
+            max_latency=float(os.environ.get('PUBLISH_MAX_LATENCY', 0.05)),
+            max_messages=int(os.environ.get('PUBLISH_MAX_MESSAGES', 100)),
+        )
+        return pubsub_v1.PublisherClient(batch_settings)
+
+    return get_client('publisher', build)
+
+# Returns: google-auth credentials with cloud-platform scope
+def get_credentials():
+    def build():
+        import google.auth
+        scoped_credentials, project = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+        return scoped_credentials
+
+    return get_client('credentials', build)
+
+# The client is built from the discovery document bundled with google-api-python-client, so
+# no fetch happens at startup; only a version that is not bundled falls back to fetching it live.
+# The discovery Resource is shared, but httplib2 connections are not thread-safe,
+# so each thread executes its requests on its own authorized Http.
+# Returns: discovery Resource for the Healthcare API version
+def get_healthcare_client(api_version):
+    def build():
+        import google_auth_httplib2
+        import httplib2
+        from googleapiclient import discovery, errors, http
+
+        credentials = get_credentials()
+        local = threading.local()
+
+        def build_request(unused_http, *args, **kwargs):
+            if not hasattr(local, 'http'):
+                local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+            return http.HttpRequest(local.http, *args, **kwargs)
+
+        try:
+            return discovery.build('healthcare', api_version, credentials=credentials,
+                                   requestBuilder=build_request, static_discovery=True)
+        except errors.UnknownApiNameOrVersion:
+            print(f'No bundled discovery document for Healthcare API {api_version}; fetching it.')
+        return discovery.build('healthcare', api_version, credentials=credentials,
+                               requestBuilder=build_request, static_discovery=False)
+
+    return get_client(f'healthcare-{api_version}', build)
+
+# Refresh the shared credentials if the token expires within margin seconds (CREDENTIALS_REFRESH_MARGIN).
+# Refreshing ahead of time, under the lock, means concurrent requests never all stop to fetch a token.
+# Returns: None
+def refresh_credentials(margin=None):
+    import datetime
+    from google.auth.transport import requests
+
+    if margin is None:
+        margin = int(os.environ.get('CREDENTIALS_REFRESH_MARGIN', 300))
+    credentials = get_credentials()
+    with _lock:
+        expiry = getattr(credentials, 'expiry', None)
+        if (credentials.token is None or expiry is None or
+                expiry - datetime.timedelta(seconds=margin) <= datetime.datetime.utcnow()):
+            start = time.perf_counter()
+            credentials.refresh(requests.Request())
+            print(f'Refreshed credentials in {(time.perf_counter() - start) * 1000:.1f} ms.')
+
+# The session keeps HTTP_POOL_SIZE keep-alive connections per host, enough for every worker
+# thread of a warm instance to reuse its own connection instead of opening a new one.
+# Returns: google.auth.transport.requests.AuthorizedSession with cloud-platform scope
+def get_authorized_session():
+    def build():
+        from google.auth.transport import requests
+        from requests.adapters import HTTPAdapter
+
+        pool_size = int(os.environ.get('HTTP_POOL_SIZE', 32))
+        session = requests.AuthorizedSession(get_credentials())
+        session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+        return session
+
+    return get_client('authorized_session', build)
@@ -0,0 +1,101 @@
+import io
+import os
+from datetime import date as date_type
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Typed schema of the columnar error logs. site and date are not stored in the files;
+# they come from the hive partition directories, {ERROR_TABLE_PATH}/site={site}/date={date}/.
+ERROR_SCHEMA = pa.schema([
+    ('time', pa.timestamp('us', tz='UTC')),
+    ('status', pa.string()),
+    ('reason', pa.string()),
+    ('exc', pa.string()),
+    ('status_code', pa.int32()),
+    ('path', pa.string()),
+    ('event_id', pa.string()),
+])
+PARTITION_SCHEMA = pa.schema([('site', pa.string()), ('date', pa.string())])
+
+# Returns: string path of the columnar error logs within the log bucket
+def error_table_path():
+    return os.environ.get('ERROR_TABLE_PATH', 'error_tables').strip('/')
+
+# Convert a day's error log rows to a typed table.
+# Returns: pyarrow.Table with ERROR_SCHEMA
+def to_error_table(logs, date):
+    logs = logs.reindex(columns=ERROR_SCHEMA.names)
+    typed = pd.DataFrame({
+        'time': pd.to_datetime(date + ' ' + logs['time'].astype(str), errors='coerce', utc=True),
+        'status': logs['status'].astype('string'),
+        'reason': logs['reason'].astype('string'),
+        'exc': logs['exc'].astype('string'),
+        'status_code': pd.to_numeric(logs['status_code'], errors='coerce').astype('Int32'),
+        'path': logs['path'].astype('string'),
+        'event_id': logs['event_id'].astype('string'),
+    })
+
+    return pa.Table.from_pandas(typed, schema=ERROR_SCHEMA, preserve_index=False)
+
+# Write a day's error log for a site as that day's Parquet partition, replacing any earlier one.
+# Returns: string GCS uri of the partition file
+def write_error_partition(bucket, site, date, logs):
+    buffer = io.BytesIO()
+    pq.write_table(to_error_table(logs, date), buffer, compression='zstd')
+    blob = bucket.blob(f'{error_table_path()}/site={site}/date={date}/errors.parquet')
+    blob.upload_from_string(data=buffer.getvalue(), content_type='application/vnd.apache.parquet')
+
+    return f'gs://{bucket.name}/{blob.name}'
+
+# Read error history from the columnar logs. Only the partitions of the given sites are listed,
+# only files in the date range are opened, and only the requested columns are read.
+# Dates are 'YYYY-MM-DD' strings and inclusive. filesystem defaults to GCS.
+# Returns: pandas.DataFrame with the requested columns, plus site and date
+def query_errors(bucket_name, sites=None, start_date=None, end_date=None,
+                 status_codes=None, reasons=None, columns=None, filesystem=None):
+    if filesystem is None:
+        from pyarrow import fs
+        filesystem = fs.GcsFileSystem()
+
+    root = f'{bucket_name}/{error_table_path()}'
+    partitioning = ds.partitioning(PARTITION_SCHEMA, flavor='hive')
+    sources = [ f'{root}/site={site}' for site in sites ] if sites else [ root ]
+    schema = pa.unify_schemas([ERROR_SCHEMA, PARTITION_SCHEMA])
+    datasets = []
+    for source in sources:
+        try:
+            datasets.append(ds.dataset(source, schema=schema, filesystem=filesystem, format='parquet',
+                                       partitioning=partitioning, partition_base_dir=root))
+        except FileNotFoundError:
+            print(f'No error logs under {source}.')
+    if not datasets:
+        return schema.empty_table().to_pandas()
+    dataset = datasets[0] if len(datasets) == 1 else ds.dataset(datasets)
+
+    # Conditions on the partition fields prune whole files before anything is read.
+    conditions = []
+    if start_date:
+        conditions.append(ds.field('date') >= str(start_date))
+    if end_date:
+        conditions.append(ds.field('date') <= str(end_date))
+    if status_codes:
+        conditions.append(ds.field('status_code').isin([ int(status_code) for status_code in status_codes ]))
+    if reasons:
+        conditions.append(ds.field('reason').isin(list(reasons)))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + ['site', 'date']))
+
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+# Returns: list of 'YYYY-MM-DD' strings from start_date to end_date inclusive
+def date_range(start_date, end_date):
+    start, end = date_type.fromisoformat(start_date), date_type.fromisoformat(end_date)
+
+    return [ day.strftime('%Y-%m-%d') for day in pd.date_range(start, end, freq='D') ]
@@ -1,11 +1,16 @@
 import os
 import sys
+import io
 import json
 import base64
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 import pandas as pd
-from google.cloud import storage
+from google.api_core import exceptions
+from clients import get_storage_client
+from error_logs import date_range, write_error_partition
+
+COLUMNS: tuple = ('time', 'status', 'reason', 'exc', 'status_code', 'path', 'event_id')
 
 
 def error_handler(event, context):
@@ -20,6 +25,7 @@ def error_handler(event, context):
 
     request_json: dict = request['message']
     request_json['time'] = time
+    request_json['event_id'] = context.event_id
 
     bucket_name: str = os.environ.get('LOG_BUCKET',
                                       'aou-curation-omop-dev_transfer_fhir')
@@ -29,20 +35,108 @@ def error_handler(event, context):
     if len(request_json['path'].split('/')) > 3:
         site = request_json['path'].split('/')[-4]
 
-    file_path: str = f'{path}/{site}/{date}/errors.csv'
+    # Each error is written as its own object under the day's shards prefix, named by the
+    # Pub/Sub event id, so concurrent invocations never touch the same object and a redelivered
+    # message finds its shard already written. compact_error_logs merges the shards into errors.csv.
+    file_path: str = f'{path}/{site}/{date}/shards/{context.event_id}.ndjson'
 
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(file_path)
 
-    columns: tuple = ('time', 'status', 'reason', 'exc', 'status_code')
-
-    if not storage.Blob(bucket=bucket, name=file_path).exists(storage_client):
-        empty_csv: str = pd.DataFrame([], columns=columns).to_csv(index=False)
-        blob.upload_from_string(data=empty_csv, content_type='text/csv')
+    try:
+        blob.upload_from_string(data=json.dumps(request_json),
+                                content_type='application/json',
+                                if_generation_match=0)
+    except exceptions.PreconditionFailed:
+        print(f'Error {context.event_id} already logged to {file_path}.')
 
-    logs = pd.read_csv(f'gs://{bucket_name}/{file_path}')
-    logs = logs.append(request_json, ignore_index=True)
-    blob.upload_from_string(data=logs.to_csv(index=False),
-                            content_type='text/csv')
     return request_json
+
+
+# Merge one site's shards for a day into its errors.csv and delete them.
+# The CSV is replaced only if it hasn't changed since it was read, so concurrent compactions
+# can't drop each other's rows, and shards whose event id is already in it are skipped,
+# so a compaction that stopped before deleting its shards can simply be run again.
+# The day's Parquet partition is rewritten from the merged CSV; with rebuild it is
+# rewritten even when there are no new shards, to convert days logged before it existed.
+# Returns: int number of errors added
+def compact_site_errors(bucket, path, site, date, rebuild=False):
+    shards = list(bucket.list_blobs(prefix=f'{path}/{site}/{date}/shards/'))
+    if not shards and not rebuild:
+        return 0
+
+    blob = bucket.blob(f'{path}/{site}/{date}/errors.csv')
+    try:
+        blob.reload()
+        logs = pd.read_csv(io.StringIO(blob.download_as_text(if_generation_match=blob.generation)), dtype=str)
+        generation = blob.generation
+    except exceptions.NotFound:
+        if not shards:
+            return 0
+        logs = pd.DataFrame([], columns=COLUMNS)
+        generation = 0
+
+    logged = set(logs['event_id'].dropna()) if 'event_id' in logs else set()
+    rows = [ json.loads(shard.download_as_text()) for shard in shards ]
+    rows = [ row for row in rows if str(row.get('event_id')) not in logged ]
+
+    logs = pd.concat([logs, pd.DataFrame(rows, columns=COLUMNS)], ignore_index=True)
+    logs = logs.sort_values('time', kind='stable')
+    if shards:
+        blob.upload_from_string(data=logs.to_csv(index=False),
+                                content_type='text/csv',
+                                if_generation_match=generation)
+    write_error_partition(bucket, site, date, logs)
+
+    for shard in shards:
+        try:
+            shard.delete()
+        except exceptions.NotFound:
+            pass
+
+    print(f'Compacted {len(shards)} shards into gs://{bucket.name}/{blob.name}; {len(rows)} errors added.')
+    return len(rows)
+
+
+def compact_error_logs(event, context):
+    """Merges the day's error shards into logs/{site}/{date}/errors.csv and its
+    Parquet partition, error_tables/site={site}/date={date}/errors.parquet.
+    Meant to run on a schedule (Cloud Scheduler to Pub/Sub). The message may name
+    the dates to compact, as "dates" or "start_date" and "end_date"; by default
+    today and yesterday (UTC) are compacted. With "rebuild": true, days without
+    new shards are converted to Parquet too.
+    """
+
+    request = {}
+    if event.get('data'):
+        request = json.loads(base64.b64decode(event['data']).decode('utf-8') or '{}')
+
+    now: datetime = datetime.now(timezone.utc)
+    dates: list = request.get('dates') or [ (now - timedelta(days=1)).strftime('%Y-%m-%d'),
+                                            now.strftime('%Y-%m-%d') ]
+    if 'start_date' in request:
+        dates = date_range(request['start_date'], request.get('end_date', now.strftime('%Y-%m-%d')))
+    rebuild: bool = bool(request.get('rebuild'))
+
+    bucket_name: str = os.environ.get('LOG_BUCKET',
+                                      'aou-curation-omop-dev_transfer_fhir')
+    path: str = os.environ.get('LOG_PATH', 'logs')
+
+    storage_client = get_storage_client()
+    bucket = storage_client.bucket(bucket_name)
+
+    # The site prefixes directly under the log path.
+    site_listing = bucket.list_blobs(prefix=f'{path}/', delimiter='/')
+    list(site_listing)
+    sites: list = [ prefix.rstrip('/').split('/')[-1] for prefix in site_listing.prefixes ]
+
+    compacted: int = 0
+    for site in sites:
+        for date in dates:
+            try:
+                compacted += compact_site_errors(bucket, path, site, date, rebuild)
+            except exceptions.PreconditionFailed:
+                print(f'errors.csv for {site} on {date} changed during compaction; it will be compacted next run.')
+
+    return {'sites': len(sites), 'errors': compacted}
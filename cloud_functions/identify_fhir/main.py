@@ -1,3 +1,55 @@
+import json
+import os
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from clients import get_authorized_session, refresh_credentials
+from ratelimit import limited_call, log_limiter_stats
+
+# Apply one identify request (an update PUT or an executeBundle POST) with the shared session.
+# Throttled requests slow the process-wide limiter down and are retried here before failing the task.
+# Raises: requests.HTTPError or RequestException if rate limited, unavailable or unreachable, so it is retried
+# Returns: string result and int number of resources that failed
+def apply_identify_request(session, identify_request):
+    method = identify_request['method']
+    id_resource_path = identify_request['resource_path']
+    headers = identify_request['request_header']
+    identify_json = identify_request['request_json']
+
+    try:
+        if method == 'BUNDLE':
+            # Execute a batch or transaction Bundle against the FHIR store base.
+            response = limited_call('healthcare', session.post, id_resource_path, headers=headers, json=identify_json)
+        else:
+            response = limited_call('healthcare', session.put, id_resource_path, headers=headers, json=identify_json)
+    except requests.exceptions.RequestException as exc:
+        # A connection error is raised so it will be retried.
+        print(f'Failed to add identifier to {id_resource_path}. {exc}')
+        raise
+
+    # If rate limit exceeded or server error, raise the error so it will be retried.
+    # We don't want to raise other failures.
+    if response.status_code in (429, 500, 503):
+        print(f'Failed to add identifier to {id_resource_path}. {response.status_code}')
+        response.raise_for_status()
+
+    if method == 'BUNDLE':
+        entries = identify_json.get('entry', [])
+        if response.ok:
+            failed = [entry_response for entry_response in response.json().get('entry', [])
+                      if not entry_response.get('response', {}).get('status', '').startswith('2')]
+        else:
+            failed = entries
+        print(f'Executed {identify_json.get("type")} bundle of {len(entries)} resources on {id_resource_path}; '
+              f'{len(failed)} failed. {response.status_code}')
+        if failed:
+            return f'Failed to add identification to {len(failed)} of {len(entries)} resources in {id_resource_path}', len(failed)
+        return f'Added identification to {len(entries)} resources in {id_resource_path}', 0
+
+    if not response.ok:
+        print(f'Failed to add identifier to {id_resource_path}. {response.status_code}')
+        return f'Failed to add identification to {id_resource_path}', 1
+
+    return f'Added identification to {id_resource_path}', 0
 
 def identify_fhir(request):
     """Responds to any HTTP request.
@@ -9,37 +61,55 @@ def identify_fhir(request):
         `make_response <http://flask.pocoo.org/docs/1.0/api/#flask.Flask.make_response>`.
     """
 
-    import json
-    import google.auth    
-    from google.auth.transport import requests    
-
     # Decode the payload.
     request_json = request.data.decode('utf8') #request.json
 
     try:
         request_json = json.loads(request_json)
-    except requests.exceptions.RequestException as exc:
-        print('Bad request. {exc.resp["status"]}')
+    except json.decoder.JSONDecodeError as exc:
+        print(f'Bad request. {exc}')
         raise
 
-    # Creates a requests Session object with the credentials.
-    scoped_credentials, project = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])     
-    session = requests.AuthorizedSession(scoped_credentials)
-
-    # Parse the input parameters from the body of the request payload.
-    method = request_json['method']
-    id_resource_path = request_json['resource_path']
-    headers = request_json['request_header']
-    identify_json = request_json['request_json']
+    # Reuse the process-wide requests Session object with the credentials. Its pooled,
+    # keep-alive connections outlive the invocation, so a warm instance skips the TLS handshake.
+    # Refresh the token here, once, before the workers share it, rather than on a worker's first 401.
+    session = get_authorized_session()
+    refresh_credentials()
 
+    # A task carries either one identify request or a list of them under "requests".
+    identify_requests = request_json.get('requests', [request_json])
     try:
-        response = session.put(id_resource_path, headers=headers, json=identify_json)
-    except requests.exceptions.RequestException as exc:
-        print(f'Failed to add identifier to {id_resource_path}. {exc.resp["status"]}')
+        return apply_identify_requests(session, identify_requests)
+    finally:
+        log_limiter_stats()
+
+# Apply the requests of one task.
+# Raises: the first retryable error, once every request has been attempted
+# Returns: string result
+def apply_identify_requests(session, identify_requests):
+    if len(identify_requests) == 1:
+        return apply_identify_request(session, identify_requests[0])[0]
+
+    # Apply the requests of the task concurrently, IDENTIFY_WORKERS at a time. Updates are idempotent,
+    # so if any of them has to be retried the whole task is raised and retried once all have finished.
+    identify_workers = int(os.environ.get('IDENTIFY_WORKERS', 8))
+
+    def apply(identify_request):
+        try:
+            return apply_identify_request(session, identify_request), None
+        except requests.exceptions.RequestException as exc:
+            return None, exc
+
+    with ThreadPoolExecutor(max_workers=min(identify_workers, len(identify_requests))) as executor:
+        results = list(executor.map(apply, identify_requests))
 
-        # If rate limit exceeded or connection error, raise the error so it will be retried.
-        # We don't want to raise other failures.
-        if exc.resp.status in (429, 500, 503):
-            raise
+    retry_errors = [exc for _, exc in results if exc is not None]
+    failed = sum(result[1] for result, exc in results if exc is None)
+    print(f'Applied {len(identify_requests) - len(retry_errors)} of {len(identify_requests)} identify requests; '
+          f'{failed} resources failed, {len(retry_errors)} requests to retry.')
+    if retry_errors:
+        raise retry_errors[0]
 
-    return f'Added identification to {id_resource_path}'  
+    if failed:
+        return f'Failed to add identification to {failed} resources with {len(identify_requests)} requests'
+    return f'Added identification with {len(identify_requests)} requests'
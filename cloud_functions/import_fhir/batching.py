@@ -0,0 +1,90 @@
+import os
+import re
+import time
+from google.api_core import exceptions
+from google.protobuf import timestamp_pb2
+from clients import get_storage_client
+from task_producer import build_http_task, enqueue_tasks
+
+# Seconds a window's flush waits after the window closes, for copies still in flight.
+FLUSH_GRACE_SECONDS = 10
+
+# Determine the HPO site and FHIR version of a file from its path,
+# the same way fhir_to_fhirstore's name_resources does.
+# Returns: string site and string FHIR version or 'unknown'
+def batch_key(file_name):
+    try:
+        hpo_site = file_name.split('/')[6].split(' ')[0]
+    except IndexError:
+        hpo_site = 'synthea'
+
+    try_version = file_name.removesuffix('.json').split('.')[-1]
+    path_parts = file_name.split('/')
+    if try_version in ('R4', 'DSTU2', 'STU3'):
+        fhir_version = try_version
+    elif 'fhir' in path_parts:
+        fhir_version = 'R4'
+    elif 'fhir_dstu2' in path_parts:
+        fhir_version = 'DSTU2'
+    elif 'fhir_stu3' in path_parts:
+        fhir_version = 'STU3'
+    else:
+        fhir_version = 'unknown'
+
+    return hpo_site, fhir_version
+
+# Create a named task, optionally scheduled for later. Cloud Tasks rejects a second task
+# with the same name, which makes each flush happen once however many events ask for it.
+# Returns: bool True if the task was created
+def enqueue_named_task(parent, task, task_id, schedule_seconds=None):
+    task['name'] = f'{parent}/tasks/{re.sub("[^A-Za-z0-9_-]", "-", task_id)}'
+    if schedule_seconds is not None:
+        schedule_time = timestamp_pb2.Timestamp()
+        schedule_time.FromSeconds(int(schedule_seconds))
+        task['schedule_time'] = schedule_time
+
+    try:
+        enqueue_tasks(parent, [task])
+        return True
+    except exceptions.AlreadyExists:
+        return False
+
+# Add a file to the micro-batch for its (site, FHIR version) and time window.
+# The file is copied under the batch prefix with its event id kept as metadata, and the
+# window's flush task is scheduled for when the window closes. Once the batch holds
+# IMPORT_BATCH_SIZE files it is flushed straight away instead. The copies go to STAGING_BUCKET,
+# set to the same bucket as fhir_to_fhirstore's; by default they go to the event's bucket, where
+# each copy invokes this function once more only to be skipped.
+# Returns: string batch prefix
+def add_to_batch(event, parent, url, service_account_email):
+    window = int(os.environ.get('IMPORT_BATCH_WINDOW', 60))
+    batch_size = int(os.environ.get('IMPORT_BATCH_SIZE', 500))
+    staging_prefix = os.environ.get('STAGING_PREFIX', 'staging').strip('/')
+
+    hpo_site, fhir_version = batch_key(event['name'])
+    window_id = int(time.time() // window)
+    batch_prefix = f'{staging_prefix}/batches/{hpo_site}/{fhir_version}/{window_id}/'
+
+    # Copy the file into the batch; the rewrite carries the metadata set on the copy.
+    storage_client = get_storage_client()
+    source_blob = storage_client.bucket(event['bucket']).blob(event['name'])
+    bucket = storage_client.bucket(os.environ.get('STAGING_BUCKET', event['bucket']))
+    batched_blob = bucket.blob(f'{batch_prefix}{event["name"]}')
+    batched_blob.metadata = {'source_id': event['id'], 'dedup_entry': event.get('dedup_entry', '')}
+    token, _, _ = batched_blob.rewrite(source_blob)
+    while token is not None:
+        token, _, _ = batched_blob.rewrite(source_blob, token=token)
+
+    batch = {'bucket': bucket.name, 'batch_prefix': batch_prefix,
+             'site': hpo_site, 'fhir_version': fhir_version}
+    flush_id = f'flush-{hpo_site}-{fhir_version}-{window_id}'
+
+    enqueue_named_task(parent, build_http_task(url, service_account_email, batch), flush_id,
+                       schedule_seconds=(window_id + 1) * window + FLUSH_GRACE_SECONDS)
+
+    batched_count = sum(1 for _ in bucket.list_blobs(prefix=batch_prefix, max_results=batch_size))
+    if batched_count >= batch_size:
+        if enqueue_named_task(parent, build_http_task(url, service_account_email, batch), f'{flush_id}-full'):
+            print(f'Batch {batch_prefix} reached {batch_size} files; flushing now.')
+
+    return batch_prefix
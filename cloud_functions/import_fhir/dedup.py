@@ -0,0 +1,137 @@
+import base64
+import hashlib
+import json
+import os
+import time
+from google.api_core import exceptions
+from clients import get_storage_client
+from batching import batch_key
+
+# Ledger of file contents already queued for import, so an identical re-upload or a repeated
+# finalize event is dropped before it is enqueued. Each entry is an empty-bodied object
+# {DEDUP_PREFIX}/{site}/{version}/{identifiers}/{hash}-{size} (prefix default: staging/dedup)
+# in DEDUP_BUCKET, or STAGING_BUCKET if that is unset, where identifiers is a digest of the
+# identifiers the file's resources get. It must be a bucket this function does not watch, or
+# every entry written would invoke it again; with neither set, deduplication is off. Entries are
+# created with if_generation_match=0 so exactly one event claims a given content. Its metadata
+# holds the state, target stores and source file, so listing the ledger needs no downloads.
+# A 'queued' claim that fhir_to_fhirstore never marks 'imported' expires after DEDUP_PENDING_TTL
+# seconds, so a failed import doesn't block the next upload; an 'imported' one after DEDUP_TTL.
+
+# Returns: string ledger prefix, '' if deduplication is off
+def dedup_prefix():
+    staging_prefix = os.environ.get('STAGING_PREFIX', 'staging').strip('/')
+
+    return os.environ.get('DEDUP_PREFIX', f'{staging_prefix}/dedup').strip('/')
+
+# Returns: string ledger bucket, or None if deduplication is off
+def dedup_bucket():
+    return os.environ.get('DEDUP_BUCKET', os.environ.get('STAGING_BUCKET'))
+
+# Returns: float seconds an entry in state stays valid
+def entry_ttl(state):
+    if state == 'imported':
+        return float(os.environ.get('DEDUP_TTL', 30 * 24 * 3600))
+
+    return float(os.environ.get('DEDUP_PENDING_TTL', 6 * 3600))
+
+# Determine whether a ledger entry has expired, from its metadata.
+# Returns: bool
+def entry_expired(metadata):
+    metadata = metadata or {}
+    recorded = float(metadata.get('recorded', 0))
+
+    return time.time() - recorded >= entry_ttl(metadata.get('state'))
+
+# The content hash of the event's object: md5, or crc32c for composite objects, which have no md5.
+# The base64 digest is written as hex so it is safe in object names.
+# Returns: string hash or None
+def content_hash(event):
+    for field, prefix in (('md5Hash', 'md5'), ('crc32c', 'crc32c')):
+        if event.get(field):
+            digest = base64.b64decode(event[field]).hex()
+            return f'{prefix}-{digest}'
+
+    return None
+
+# A digest of the identifiers fhir_to_fhirstore's build_identifiers adds to the file's resources,
+# read from the event id (bucket/name/generation) the same way: collection, EHR platform, HPO site
+# and participant. The same content under another collection or participant path gets other
+# identifiers, so it is not a duplicate.
+# Returns: string hex digest
+def identifiers_digest(event):
+    file_path = (event.get('id') or f'{event["bucket"]}/{event["name"]}/{event.get("generation", "")}').split('/')
+    if len(file_path) >= 8:
+        id_values = (file_path[1], file_path[5], file_path[6].split(' ')[0], file_path[7])
+    else:
+        id_values = (file_path[1], 'Synthea', 'Synthea', file_path[-1].removesuffix('.json').split('_')[-1])
+
+    return hashlib.sha256('\n'.join(id_values).encode('utf-8')).hexdigest()[:16]
+
+# Claim the event's file content in the ledger.
+# Returns: string GCS uri of the claimed entry, or None if identical content is already claimed
+#          (or '' if deduplication is off or the event has no hash)
+def claim_file(event):
+    ledger_prefix = dedup_prefix()
+    ledger_bucket = dedup_bucket()
+    file_hash = content_hash(event)
+    if not ledger_prefix or not ledger_bucket or file_hash is None:
+        return ''
+
+    hpo_site, fhir_version = batch_key(event['name'])
+    bucket = get_storage_client().bucket(ledger_bucket)
+    blob = bucket.blob(f'{ledger_prefix}/{hpo_site}/{fhir_version}/{identifiers_digest(event)}/{file_hash}-{event.get("size", 0)}')
+    blob.metadata = {
+        'state': 'queued',
+        'recorded': str(time.time()),
+        'site': hpo_site,
+        'fhir_version': fhir_version,
+        'stores': json.dumps([f'fhir-{hpo_site}-{fhir_version}', f'fhir-combined-{fhir_version}']),
+        'source': f'gs://{event["bucket"]}/{event["name"]}#{event.get("generation", "")}',
+    }
+
+    try:
+        blob.upload_from_string('', content_type='application/json', if_generation_match=0)
+    except exceptions.PreconditionFailed:
+        # Take over an expired entry; if another event takes it over first, that one wins.
+        existing = bucket.get_blob(blob.name)
+        if existing is None or not entry_expired(existing.metadata):
+            source = (existing.metadata or {}).get('source') if existing is not None else None
+            print(f'Identical content already queued from {source}; skipping {event["name"]}.')
+            return None
+        try:
+            blob.upload_from_string('', content_type='application/json', if_generation_match=existing.generation)
+        except exceptions.PreconditionFailed:
+            return None
+
+    return f'gs://{bucket.name}/{blob.name}'
+
+# Give up a claim, when the file could not be queued after all, so the next event for it isn't dropped.
+# Returns: None
+def release_claim(dedup_entry):
+    if not dedup_entry:
+        return
+    bucket_name, _, blob_name = dedup_entry.removeprefix('gs://').partition('/')
+    try:
+        get_storage_client().bucket(bucket_name).blob(blob_name).delete()
+    except exceptions.NotFound:
+        pass
+
+# Delete expired ledger entries, so the ledger only holds content seen within the TTLs.
+# Returns: int number of entries deleted
+def compact_ledger(bucket_name):
+    ledger_prefix = dedup_prefix()
+    bucket = get_storage_client().bucket(bucket_name)
+
+    deleted = 0
+    for blob in bucket.list_blobs(prefix=f'{ledger_prefix}/'):
+        if not entry_expired(blob.metadata):
+            continue
+        try:
+            blob.delete(if_generation_match=blob.generation)
+            deleted += 1
+        except (exceptions.NotFound, exceptions.PreconditionFailed):
+            pass
+
+    print(f'Deleted {deleted} expired entries from gs://{bucket_name}/{ledger_prefix}/.')
+    return deleted
@@ -9,11 +9,27 @@ def import_fhir(event, context):
     import json
     import os
     import requests
-    from google.cloud import tasks_v2
+    from task_producer import build_http_task, enqueue_tasks, get_queue_path
+    from batching import add_to_batch, batch_key
+    from dedup import claim_file, release_claim
+    from scheduling import get_site_queue_path, site_queues_enabled
 
     file = event
+
+    # Files staged by fhir_to_fhirstore are imported by that function; don't queue them again.
+    staging_prefix = os.environ.get('STAGING_PREFIX', 'staging').strip('/')
+    if file['name'].startswith(f'{staging_prefix}/'):
+        return "Skipping staged file."
+
     print(f"Processing file: {file['name']}.")
 
+    # Drop a file whose content was already queued for the same site and version, e.g. an
+    # identical re-upload or a repeated finalize event. fhir_to_fhirstore confirms the entry once imported.
+    dedup_entry = claim_file(file)
+    if dedup_entry is None:
+        return "Skipping file with content already imported."
+    file['dedup_entry'] = dedup_entry
+
     # Set the queue and cloud function variables.
     project = os.environ.get('GCP_PROJECT')    
     queue_name = os.environ.get('TASK_QUEUE')
@@ -23,39 +39,72 @@ def import_fhir(event, context):
 
     url = f"https://{location}-{project}.cloudfunctions.net/{import_function}"
 
-    # Create a client.
-    client = tasks_v2.CloudTasksClient()
+    # The queue is resolved and verified once per process.
+    # With per-site queues, the site is read from the object path the same way fhir_to_fhirstore does.
+    if site_queues_enabled():
+        hpo_site, _ = batch_key(file['name'])
+        parent = get_site_queue_path(project, location, queue_name, hpo_site)
+    else:
+        parent = get_queue_path(project, location, queue_name)
 
-    # Construct the fully qualified queue name.
-    parent = client.queue_path(project, location, queue_name)
+    try:
+        # In batching mode, add the file to its (site, FHIR version) micro-batch;
+        # one task later imports the whole batch.
+        if os.environ.get('IMPORT_BATCH_MODE', '').lower() in ('1', 'true', 'yes'):
+            batch_prefix = add_to_batch(file, parent, url, service_account_email)
+            return f"File added to import batch {batch_prefix}."
+
+        # Construct the task and use the shared producer to send it.
+        task = build_http_task(url, service_account_email, file)
+        response = enqueue_tasks(parent, [task])
+    except Exception:
+        release_claim(dedup_entry)
+        raise
+
+    return "Task added to queue for processing."
 
-    # Get the queue object.
-    queue = client.get_queue(request=None, name=parent)
 
-    # Create the task queue if it doesn't exist; update if it already exists.
-    client.update_queue(request=None, queue=queue)
+def compact_dedup_ledger(event, context):
+    """Deletes expired entries from the import deduplication ledger.
+    Meant to run on a schedule (Cloud Scheduler to Pub/Sub).
+    Args:
+         event (dict): Event payload; its data may name the ledger "bucket".
+         context (google.cloud.functions.Context): Metadata for the event.
+    """
 
-    # Construct the request body.
-    task = {
-        "http_request": {  # Specify the type of request.
-            "http_method": tasks_v2.HttpMethod.POST,
-            "url": url,  # The full url path that the task will be sent to.
-            "oidc_token": {"service_account_email": service_account_email, "audience": url},
-        }
-    }
+    import base64
+    import json
+    import os
+    from dedup import compact_ledger, dedup_bucket
 
-    if isinstance(file, dict):
-        # convert dict to JSON string
-        file = json.dumps(file)
+    request = {}
+    if event.get('data'):
+        request = json.loads(base64.b64decode(event['data']).decode('utf-8') or '{}')
+    bucket_name = request.get('bucket', dedup_bucket())
 
-    if file is not None:
-        # The API expects a payload of type bytes
-        converted_payload = file.encode()
+    return {'deleted': compact_ledger(bucket_name)}
 
-        # Add the payload to the request body
-        task['http_request']['body'] = converted_payload  
-    
-    # Use the client to build and send the task.
-    response = client.create_task(request={"parent": parent, "task": task})
 
-    return "Task added to queue for processing."
+def site_queue_stats(request):
+    """Reports the depth of the import queue and of each site's queue.
+    Args:
+        request (flask.Request): HTTP request object.
+    Returns:
+        dict of site to tasks waiting, oldest task age and dispatch settings.
+    """
+
+    import json
+    import os
+    from scheduling import site_queue_depths
+
+    project = os.environ.get('GCP_PROJECT')
+    queue_name = os.environ.get('TASK_QUEUE')
+    location = os.environ.get('TASK_QUEUE_LOCATION')
+
+    depths = site_queue_depths(project, location, queue_name)
+
+    # One structured log line per queue, for log-based metrics of queue depth per site.
+    for hpo_site, depth in depths.items():
+        print(json.dumps({'metric': 'site_queue_depth', 'site': hpo_site, **depth}))
+
+    return depths
@@ -0,0 +1,117 @@
+import json
+import os
+import re
+import threading
+import time
+from google.api_core import exceptions
+from clients import get_client, get_tasks_client
+from task_producer import get_queue_path
+
+# Per-site queues, so one site's bulk upload only fills its own queue and every other site's
+# tasks keep being dispatched at their own rate. With SITE_QUEUES=site, each site's tasks go to
+# {TASK_QUEUE}-{site}, created on first use with the base queue's retry settings.
+# Each site queue dispatches SITE_DISPATCH_RATE tasks per second with at most SITE_MAX_CONCURRENT
+# in flight, both multiplied by the site's weight in SITE_QUEUE_WEIGHTS (a JSON object of site to
+# weight; the "default" key applies to unlisted sites).
+_site_queue_paths = {}
+_lock = threading.Lock()
+
+# Returns: bool True if tasks are routed to per-site queues
+def site_queues_enabled():
+    return os.environ.get('SITE_QUEUES', 'shared').lower() == 'site'
+
+# Queue ids allow letters, numbers and hyphens, up to 100 characters.
+# Returns: string queue id of the site's queue
+def site_queue_id(queue_name, hpo_site):
+    return re.sub('[^A-Za-z0-9-]', '-', f'{queue_name}-{hpo_site}')[:100].rstrip('-')
+
+# Returns: dict of rate limits for the site's queue
+def site_rate_limits(hpo_site):
+    weights = json.loads(os.environ.get('SITE_QUEUE_WEIGHTS', '{}'))
+    weight = float(weights.get(hpo_site, weights.get('default', 1)))
+    dispatch_rate = float(os.environ.get('SITE_DISPATCH_RATE', 1))
+    max_concurrent = int(os.environ.get('SITE_MAX_CONCURRENT', 5))
+
+    return {
+        'max_dispatches_per_second': dispatch_rate * weight,
+        'max_concurrent_dispatches': max(1, int(max_concurrent * weight)),
+    }
+
+# Find, create or reconfigure the site's queue, once per process, so its rate limits follow the settings.
+# Returns: string queue path
+def get_site_queue_path(project, location, queue_name, hpo_site):
+    key = (project, location, queue_name, hpo_site)
+    if key in _site_queue_paths:
+        return _site_queue_paths[key]
+
+    client = get_tasks_client()
+    base_path = get_queue_path(project, location, queue_name)
+    path = client.queue_path(project, location, site_queue_id(queue_name, hpo_site))
+    rate_limits = site_rate_limits(hpo_site)
+
+    try:
+        queue = client.get_queue(name=path)
+        if (queue.rate_limits.max_dispatches_per_second != rate_limits['max_dispatches_per_second'] or
+                queue.rate_limits.max_concurrent_dispatches != rate_limits['max_concurrent_dispatches']):
+            client.update_queue(request={
+                'queue': {'name': path, 'rate_limits': rate_limits},
+                'update_mask': {'paths': ['rate_limits.max_dispatches_per_second',
+                                          'rate_limits.max_concurrent_dispatches']},
+            })
+            print(f'Updated rate limits of {path}: {rate_limits}')
+    except exceptions.NotFound:
+        base_queue = client.get_queue(name=base_path)
+        try:
+            client.create_queue(request={
+                'parent': f'projects/{project}/locations/{location}',
+                'queue': {'name': path, 'rate_limits': rate_limits, 'retry_config': base_queue.retry_config},
+            })
+            print(f'Created queue {path}: {rate_limits}')
+        except exceptions.AlreadyExists:
+            pass
+
+    with _lock:
+        _site_queue_paths[key] = path
+
+    return path
+
+# Queue stats are only served by the v2beta3 API; the queues themselves are the same.
+# Returns: google.cloud.tasks_v2beta3.CloudTasksClient
+def get_tasks_stats_client():
+    def build():
+        from google.cloud import tasks_v2beta3
+        return tasks_v2beta3.CloudTasksClient()
+
+    return get_client('tasks-v2beta3', build)
+
+# Read the depth of the base queue and every site queue from the Cloud Tasks queue stats.
+# Returns: dict of site ('shared' for the base queue) to tasks, oldest task age and dispatch settings
+def site_queue_depths(project, location, queue_name):
+    client = get_tasks_stats_client()
+    base_path = client.queue_path(project, location, queue_name)
+    site_prefix = f'{base_path}-'
+    request = {
+        'parent': f'projects/{project}/locations/{location}',
+        'read_mask': {'paths': ['name', 'rate_limits', 'stats']},
+    }
+
+    depths = {}
+    for queue in client.list_queues(request=request):
+        if queue.name == base_path:
+            hpo_site = 'shared'
+        elif queue.name.startswith(site_prefix):
+            hpo_site = queue.name[len(site_prefix):]
+        else:
+            continue
+        oldest = queue.stats.oldest_estimated_arrival_time
+        depths[hpo_site] = {
+            'queue': queue.name,
+            'tasks': queue.stats.tasks_count,
+            'oldest_task_age_seconds': round(time.time() - oldest.timestamp(), 1) if oldest else 0,
+            'executed_last_minute': queue.stats.executed_last_minute_count,
+            'concurrent_dispatches': queue.stats.concurrent_dispatches_count,
+            'max_dispatches_per_second': queue.rate_limits.max_dispatches_per_second,
+            'max_concurrent_dispatches': queue.rate_limits.max_concurrent_dispatches,
+        }
+
+    return depths
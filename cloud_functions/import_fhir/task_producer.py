@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import tasks_v2
+from clients import get_tasks_client
+
+# The verified queue paths are kept for the life of the process,
+# so warm instances only pay for create_task.
+_queue_paths = {}
+_lock = threading.Lock()
+
+# When set, sink(parent, task) receives every task instead of Cloud Tasks, so the stages
+# can run in one process (see fhir_to_fhirstore/pipeline.py).
+_task_sink = None
+
+# Send the tasks enqueued from now on to sink(parent, task), which returns the created task;
+# None sends them to Cloud Tasks again.
+# Returns: None
+def set_task_sink(sink):
+    global _task_sink
+    _task_sink = sink
+
+# Construct the fully qualified queue name and check the queue exists, once per process.
+# With a task sink there is no queue to check.
+# Returns: string queue path
+def get_queue_path(project, location, queue_name):
+    if _task_sink is not None:
+        return f'projects/{project}/locations/{location}/queues/{queue_name}'
+
+    key = (project, location, queue_name)
+    if key in _queue_paths:
+        return _queue_paths[key]
+
+    client = get_tasks_client()
+    parent = client.queue_path(project, location, queue_name)
+
+    # Raises NotFound if the queue does not exist.
+    client.get_queue(name=parent)
+
+    with _lock:
+        _queue_paths[key] = parent
+
+    return parent
+
+# Build a task that POSTs the payload to a Cloud Function with an OIDC token.
+# Returns: task dict
+def build_http_task(url, service_account_email, payload):
+    task = {
+        "http_request": {  # Specify the type of request.
+            "http_method": tasks_v2.HttpMethod.POST,
+            "url": url,  # The full url path that the task will be sent to.
+            "oidc_token": {"service_account_email": service_account_email, "audience": url},
+        }
+    }
+
+    if isinstance(payload, dict):
+        # Convert dict to JSON string.
+        payload = json.dumps(payload)
+
+    if payload is not None:
+        # The API expects a payload of type bytes.
+        task['http_request']['body'] = payload.encode()
+
+    return task
+
+# Submit tasks to the queue concurrently, with at most max_workers create_task calls in flight.
+# Returns: list of created tasks, in the same order as the input
+def enqueue_tasks(parent, tasks, max_workers=None):
+    if max_workers is None:
+        max_workers = int(os.environ.get('TASK_ENQUEUE_WORKERS', 16))
+
+    if _task_sink is not None:
+        return [ _task_sink(parent, task) for task in tasks ]
+
+    client = get_tasks_client()
+
+    def create_task(task):
+        return client.create_task(request={"parent": parent, "task": task})
+
+    start = time.perf_counter()
+    if len(tasks) <= 1 or max_workers <= 1:
+        responses = [create_task(task) for task in tasks]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+            responses = list(executor.map(create_task, tasks))
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    print(f'Enqueued {len(tasks)} tasks to {parent} in {elapsed_ms:.1f} ms.')
+
+    return responses